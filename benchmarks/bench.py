@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of ok_ssh without a MATE desktop and real servers: dconf, ssh-copy-id, ssh, sshpass,
+ssh-keyscan and expect.exp are replaced by stubs.py, inventories of the given sizes are generated.
+For every run, reports wall time, number of spawned stubs and peak RSS of ok_ssh
+
+usage: bench.py [--sizes 10 1000 10000] [--latency 0.01] [--save FILE] [--compare FILE] ...
+"""
+
+import sys
+import os
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR: str = os.path.abspath(os.path.dirname(sys.argv[0]))
+SOURCE_DIR: str = os.path.join(os.path.dirname(BENCH_DIR), 'source')
+STUBS: tuple = ('dconf', 'ssh-copy-id', 'ssh', 'sshpass', 'ssh-keyscan')
+BASE_PROFILE: dict = {
+    'allow-bold': 'true', 'background-color': "'#000000'", 'font': "'Monospace 12'",
+    'palette': "'#2E3436:#CC0000:#4E9A06'", 'scrollback-lines': '1000', 'use-system-font': 'false',
+    'word-chars': "'-A-Za-z0-9,./?%&#:_=+@~'", 'visible-name': "'profile0'",
+}
+
+# (name, options of ok_ssh); '-i' runs are repeated runs without changes of the inventory
+SCENARIOS: tuple = (
+    ('dconf', ['-d']),
+    ('dconf -i', ['-d', '-i']),
+    ('ssh', ['-s']),
+    ('ssh -i', ['-s', '-i']),
+)
+
+
+def generate_inventory(work_dir: str, size: int):
+    """ servers.yml with size servers (host00000..., 10.x.y.z) """
+    lines = [
+        '---',
+        'keys:',
+        '  bench:',
+        '    public_key: %s' % os.path.join(work_dir, 'id_bench.pub'),
+        '    private_key: %s' % os.path.join(work_dir, 'id_bench'),
+        'authorization:',
+        '  user_1:',
+        "    username: 'root'",
+        "    password: 'bench'",
+        "base_profile: 'profile0'",
+        "ssh_config_dest: '%s'" % os.path.join(work_dir, 'ssh_config'),
+        'opts_key_from_base_profile: %s' % json.dumps(sorted(key for key in BASE_PROFILE if key != 'visible-name')),
+        'dict_of_servers:',
+    ]
+    for index in range(size):
+        lines += [
+            '  host%05d:' % index,
+            '    i_want_add: true',
+            "    ip: '10.%d.%d.%d'" % (index >> 16 & 255, index >> 8 & 255, index & 255),
+            '    port: 22',
+            '    keys: "{{ keys.bench }}"',
+            '    authorization: "{{ authorization.user_1 }}"',
+        ]
+    with open(os.path.join(work_dir, 'source', 'servers.yml'), 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def prepare(size: int):
+    """
+    Working directory: copy of ok_ssh (its caches, states and backups stay there), stubs in bin/,
+    the inventory, a key pair, an empty ssh config and the dconf tree with the base profile
+    :return: path
+    """
+    work_dir = tempfile.mkdtemp(prefix='ok_ssh_bench_%d_' % size)
+    os.makedirs(os.path.join(work_dir, 'source'))
+    os.makedirs(os.path.join(work_dir, 'bin'))
+    shutil.copy(os.path.join(SOURCE_DIR, 'ok_ssh.py'), os.path.join(work_dir, 'source'))
+    # copies of stubs.py for the current interpreter, without 'site' (the start of a stub is cheaper)
+    with open(os.path.join(BENCH_DIR, 'stubs.py')) as file:
+        stubs = '#!%s -S\n' % sys.executable + file.read().split('\n', 1)[1]
+    for stub in [os.path.join(work_dir, 'bin', stub) for stub in STUBS] + \
+            [os.path.join(work_dir, 'source', 'expect.exp')]:
+        with open(stub, 'w') as file:
+            file.write(stubs)
+        os.chmod(stub, 0o755)
+
+    generate_inventory(work_dir, size)
+    with open(os.path.join(work_dir, 'id_bench.pub'), 'w') as file:
+        file.write('ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBenchBenchBenchBenchBenchBenchBenchBench bench\n')
+    open(os.path.join(work_dir, 'id_bench'), 'w').close()
+    open(os.path.join(work_dir, 'ssh_config'), 'w').close()
+
+    dconf = {'/org/mate/terminal/global/profile-list': "['default', 'profile0']",
+             '/org/mate/terminal/profiles/default/visible-name': "'Default'"}
+    for key, value in BASE_PROFILE.items():
+        dconf['/org/mate/terminal/profiles/profile0/' + key] = value
+    with open(os.path.join(work_dir, 'dconf.json'), 'w') as file:
+        json.dump(dconf, file)
+    return work_dir
+
+
+def run_ok_ssh(work_dir: str, options: list, arguments: argparse.Namespace):
+    """
+    :return: dict(wall, spawned, peak_rss_mb, returncode)
+    """
+    env = dict(os.environ, BENCH_DIR=work_dir, BENCH_LATENCY=str(arguments.latency),
+               BENCH_FAILURE_RATE=str(arguments.failure_rate), BENCH_ACCEPT_RATE=str(arguments.accept_rate),
+               PATH=os.path.join(work_dir, 'bin') + os.pathsep + os.environ['PATH'])
+    calls_log = os.path.join(work_dir, 'calls.log')
+    if os.path.isfile(calls_log):
+        os.remove(calls_log)
+    command = [sys.executable, os.path.join(work_dir, 'source', 'ok_ssh.py'),
+               '-y', os.path.join(work_dir, 'source', 'servers.yml'), '-n',
+               '--connect_timeout', '0',  # the generated addresses don't exist
+               '-j', str(arguments.jobs), '--auto_authorization_method', arguments.method] + options
+
+    with open(os.path.join(work_dir, 'output.log'), 'a') as output:
+        output.write('\n$ %s\n' % ' '.join(command))
+        output.flush()
+        started = time.monotonic()
+        proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=output, stderr=output, env=env)
+        _, status, rusage = os.wait4(proc.pid, 0)  # rusage of ok_ssh and its reaped children
+        wall = time.monotonic() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    spawned = 0
+    if os.path.isfile(calls_log):
+        with open(calls_log) as file:
+            spawned = sum(1 for _ in file)
+    return dict(wall=round(wall, 3), spawned=spawned, peak_rss_mb=round(rusage.ru_maxrss / 1024, 1),
+                returncode=proc.returncode)
+
+
+def compare(results: list, baseline_file: str, tolerance: float):
+    """
+    :return: list of messages about runs that are slower / spawn more than the baseline (+ tolerance)
+    """
+    with open(baseline_file) as file:
+        baseline = {(result['size'], result['scenario']): result for result in json.load(file)}
+    regressions = []
+    for result in results:
+        old = baseline.get((result['size'], result['scenario']))
+        if old is None:
+            continue
+        for metric in ('wall', 'spawned', 'peak_rss_mb'):
+            if result[metric] > old[metric] * (1 + tolerance) and result[metric] - old[metric] > 0.05:
+                regressions.append('%s/%s: %s %s -> %s' % (
+                    result['size'], result['scenario'], metric, old[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of ok_ssh with stubs instead of '
+                                                 'dconf/ssh-copy-id/sshpass/expect')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 1000, 10000],
+                        help='Sizes of generated inventories (default=10 1000 10000)')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='Seconds of a network round of the stubs (default=0.01)')
+    parser.add_argument('--failure_rate', type=float, default=0.05,
+                        help='Share of hosts on which sending the key fails (default=0.05)')
+    parser.add_argument('--accept_rate', type=float, default=0.5,
+                        help='Share of hosts that already accept the key (default=0.5)')
+    parser.add_argument('--method', default='pty', choices=['pty', 'sshpass', 'expect'],
+                        help='--auto_authorization_method of ok_ssh (default=pty)')
+    parser.add_argument('-j', '--jobs', type=int, default=10, help='--jobs of ok_ssh (default=10)')
+    parser.add_argument('--save', metavar='FILE', help='Save results as json (a baseline for --compare)')
+    parser.add_argument('--compare', metavar='FILE', help='Exit with code 1 if a run is worse than in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed growth of a metric for --compare (default=0.2)')
+    parser.add_argument('--keep', action='store_true', help="Don't delete working directories")
+    arguments = parser.parse_args()
+
+    results = []
+    print('%8s  %-10s %10s %10s %14s' % ('hosts', 'scenario', 'wall, s', 'spawned', 'peak RSS, MB'))
+    for size in arguments.sizes:
+        work_dir = prepare(size)
+        for scenario, options in SCENARIOS:
+            result = dict(size=size, scenario=scenario, **run_ok_ssh(work_dir, options, arguments))
+            results.append(result)
+            print('%8d  %-10s %10.2f %10d %14.1f%s' % (
+                size, scenario, result['wall'], result['spawned'], result['peak_rss_mb'],
+                '' if result['returncode'] == 0 else '  (exit code %d, see %s)' % (
+                    result['returncode'], os.path.join(work_dir, 'output.log'))))
+        if arguments.keep:
+            print('Working directory: %s' % work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    if arguments.save:
+        with open(arguments.save, 'w') as file:
+            json.dump(results, file, indent=1)
+    if arguments.compare:
+        regressions = compare(results, arguments.compare, arguments.tolerance)
+        if regressions:
+            print('\nRegressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
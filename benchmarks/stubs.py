@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Stand-ins for the programs called by ok_ssh (the role is chosen by the name of the link):
+dconf, ssh-copy-id, sshpass, expect.exp, ssh, ssh-keyscan.
+Every call is appended to $BENCH_DIR/calls.log, dconf keeps its tree in $BENCH_DIR/dconf.json.
+
+Environment:
+BENCH_LATENCY      - seconds of a network round (ssh-copy-id, ssh, ssh-keyscan), default 0
+BENCH_FAILURE_RATE - share of hosts on which ssh-copy-id fails, default 0
+BENCH_ACCEPT_RATE  - share of hosts that already accept the key (ssh ... true), default 0
+"""
+
+import sys
+import os
+import json
+import time
+import fcntl
+import zlib
+
+BENCH_DIR = os.environ['BENCH_DIR']
+ROLE = os.path.basename(sys.argv[0])
+LATENCY = float(os.environ.get('BENCH_LATENCY', 0))
+
+
+def log_call():
+    fd = os.open(os.path.join(BENCH_DIR, 'calls.log'), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    os.write(fd, (ROLE + ' ' + ' '.join(sys.argv[1:3]) + '\n').encode())
+    os.close(fd)
+
+
+def host_share(host: str):
+    """ Stable pseudo-random number in [0, 1) for the host (the same host fails in every run) """
+    return zlib.crc32(host.encode()) % 1000 / 1000
+
+
+def dconf():
+    db_file = os.path.join(BENCH_DIR, 'dconf.json')
+    with open(db_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        db = json.load(open(db_file)) if os.path.isfile(db_file) else {}
+        command, args = sys.argv[1], sys.argv[2:]
+        changed = False
+        if command == 'read':
+            if args[-1] in db:
+                print(db[args[-1]])
+        elif command == 'write':
+            db[args[0]] = args[1]
+            changed = True
+        elif command == 'list':
+            items = set()
+            for key in db:
+                if key.startswith(args[0]):
+                    rest = key[len(args[0]):]
+                    items.add(rest.split('/')[0] + ('/' if '/' in rest else ''))
+            print('\n'.join(sorted(items)))
+        elif command == 'reset':
+            path = args[-1]
+            for key in list(db):
+                if key == path or (path.endswith('/') and key.startswith(path)):
+                    del db[key]
+            changed = True
+        elif command == 'dump':
+            sections = {}
+            for key, value in db.items():
+                if key.startswith(args[0]):
+                    section, _, name = key[len(args[0]):].rpartition('/')
+                    sections.setdefault(section or '/', {})[name] = value
+            for section in sorted(sections):
+                print('[%s]' % section)
+                for name in sorted(sections[section]):
+                    print('%s=%s' % (name, sections[section][name]))
+                print()
+        elif command == 'load':
+            section = None
+            for line in sys.stdin.read().splitlines():
+                if line.startswith('[') and line.endswith(']'):
+                    section = line[1:-1]
+                elif '=' in line and section is not None:
+                    name, value = line.split('=', 1)
+                    db[args[-1] + ('' if section == '/' else section + '/') + name] = value
+            changed = True
+        else:
+            sys.exit('dconf stub: unknown command %s' % command)
+        if changed:
+            with open(db_file + '.tmp', 'w') as file:
+                json.dump(db, file)
+            os.replace(db_file + '.tmp', db_file)
+
+
+def ssh_copy_id():
+    destination = sys.argv[-1]
+    if not os.environ.get('BENCH_PASSWORD_GIVEN'):  # like ssh: ask on the terminal
+        tty = os.open('/dev/tty', os.O_RDWR)
+        os.write(tty, ("%s's password: " % destination).encode())
+        while not os.read(tty, 1024).endswith((b'\n', b'\r')):
+            pass
+        os.close(tty)
+    time.sleep(LATENCY * 2)
+    if host_share('failure ' + destination) < float(os.environ.get('BENCH_FAILURE_RATE', 0)):
+        print('Permission denied, please try again.', file=sys.stderr)
+        sys.exit(1)
+    print('Number of key(s) added: 1')
+
+
+def ssh():
+    if '-G' in sys.argv:
+        print('hostname %s' % sys.argv[-1])
+        return
+    time.sleep(LATENCY)
+    if host_share('accept ' + sys.argv[-2]) < float(os.environ.get('BENCH_ACCEPT_RATE', 0)):
+        return
+    print('Permission denied (publickey).', file=sys.stderr)
+    sys.exit(255)
+
+
+def ssh_keyscan():
+    time.sleep(LATENCY)
+    args = sys.argv[1:]
+    port = args[args.index('-p') + 1] if '-p' in args else '22'
+    for ip in [arg for index, arg in enumerate(args) if not arg.startswith('-') and args[index - 1] not in ('-T', '-p')]:
+        name = ip if port == '22' else '[%s]:%s' % (ip, port)
+        print('%s ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAA%08x' % (name, zlib.crc32(name.encode())))
+
+
+def password_wrapper(command: list):
+    """ sshpass -p PASSWORD command... / expect.exp PASSWORD command... """
+    os.environ['BENCH_PASSWORD_GIVEN'] = '1'
+    os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    log_call()
+    if ROLE == 'dconf':
+        dconf()
+    elif ROLE == 'ssh-copy-id':
+        ssh_copy_id()
+    elif ROLE == 'ssh':
+        ssh()
+    elif ROLE == 'ssh-keyscan':
+        ssh_keyscan()
+    elif ROLE == 'sshpass':
+        password_wrapper(sys.argv[3:])
+    elif ROLE == 'expect.exp':
+        password_wrapper(sys.argv[2:])
+    else:
+        sys.exit('Unknown stub: %s' % ROLE)
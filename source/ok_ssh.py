@@ -2,16 +2,38 @@
 
 import sys
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import subprocess
 import argparse
-import shutil
 import re
+import glob
+import json
+import pickle
+import base64
+import hashlib
+import gzip
+import hmac
+import bisect
+import fnmatch
+import ipaddress
+import pty
+import time
+import random
+import signal
+import selectors
+import socket
+import errno
+import tempfile
+import shlex
+import threading
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import yaml  # pyyaml
 from jinja2 import FileSystemLoader, Environment
 from ast import literal_eval  # dict/list as str to dict/list
-from sshconf import read_ssh_config, empty_ssh_config_file  # https://github.com/sorend/sshconf
+from sshconf import SshConfigFile  # https://github.com/sorend/sshconf
 
 SCRIPT_DIR: str = os.path.abspath(os.path.dirname(sys.argv[0]))
 TIME_POSTFIX = False
@@ -25,6 +47,7 @@ class StaticMethods:
     """ Typical functions of program's"""
     SAVE_DIR: str = SCRIPT_DIR
     TIME_POSTFIX: bool = TIME_POSTFIX
+    DCONF_SNAPSHOTS: dict = {}  # dir schema -> parsed 'dconf dump' (see dconf_snapshot)
 
     @staticmethod
     def select_yes_or_no(question: str, yes_by_default: bool = True):
@@ -39,43 +62,6 @@ class StaticMethods:
         else:
             return False
 
-    @staticmethod
-    def dconf_backup_command(schema: str, create_backup_file: bool = True):
-        """
-        Backup dconf schema properties
-        :param schema: Schema for backup. Only path! (without schema+value)
-        :param create_backup_file: Whether to create a file with which you can restore the previous state
-        :return: Bash command for restore from dconf
-        :rtype: str
-        """
-        backup_file = os.path.join(StaticMethods.SAVE_DIR, schema[1:].replace('/', '.') + 'ini')
-        proc = subprocess.Popen(
-            ['dconf', 'dump', schema],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        proc.wait()
-
-        (stdout, stderr) = proc.communicate()
-        if proc.returncode != 0:  # if err
-            print("stderr: ", stderr)
-            if not StaticMethods.select_yes_or_no(
-                    "Command 'dconf dump %s > %s' failed! Do you want to continue anyway?" % (schema, backup_file),
-                    yes_by_default=False
-            ):
-                print('Aborted!')
-                sys.exit(0)
-        else:
-
-            if create_backup_file:
-                backup_file = StaticMethods.save_file(backup_file, stdout, mode='wb')
-                # print("\nSuccessful backup for сommand 'dconf dump %s > %s' !" % (schema, backup_file))
-                command = "dconf reset -f %s\ndconf load %s < '%s'" % (schema, schema, backup_file)
-                # print("To restore use command:\n%s" % command)
-                return command
-            else:
-                print(stdout)
-
     @staticmethod
     def save_file(save_to: str, data, time_postfix=None, mode='w', chmod: str = None):
         """
@@ -89,15 +75,42 @@ class StaticMethods:
         if time_postfix:
             save_to = StaticMethods.get_name_with_time_postfix(save_to)
 
-        with open(save_to, mode) as file:
+        opener = None
+        if chmod is not None:  # a new file is created with these permissions, not readable by others even for a moment
+            chmod = int(chmod, base=8)
+            opener = lambda path, flags: os.open(path, flags, chmod)
+
+        with open(save_to, mode, opener=opener) as file:
+            if chmod is not None:  # the file may already exist
+                os.fchmod(file.fileno(), chmod)
             if type(data) == list:
                 data = '\n'.join(data)
             file.write(data)
 
-        if chmod is not None:
-            chmod = int(chmod, base=8)
-            os.chmod(save_to, chmod)
+        return save_to
 
+    @staticmethod
+    def write_file_atomically(save_to: str, data: str, chmod: str = '600'):
+        """
+        Replace the file atomically: temp file in the same dir + rename. Symlinks are followed.
+        Permissions of an existing file are kept
+        :param data: str or bytes
+        :param chmod: permissions of a new file
+        :return: the path where the file was saved
+        :rtype: str
+        """
+        save_to = os.path.realpath(save_to)  # don't replace a symlink with a file
+        mode = os.stat(save_to).st_mode & 0o777 if os.path.isfile(save_to) else int(chmod, base=8)
+        os.makedirs(os.path.dirname(save_to), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(prefix='.ok_ssh.', dir=os.path.dirname(save_to))
+        try:
+            with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as file:
+                file.write(data)
+            os.chmod(tmp_file, mode)
+            os.replace(tmp_file, save_to)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
         return save_to
 
     @staticmethod
@@ -127,9 +140,10 @@ class StaticMethods:
         :return: output: str if successful else False
         """
         try:
-            return subprocess.check_output(
-                ['dconf', 'read' if not list_ else 'list', schema], universal_newlines=True
-            ).replace('\n', '')
+            with RunStats.command(['dconf', 'read' if not list_ else 'list', schema]):
+                return subprocess.check_output(
+                    ['dconf', 'read' if not list_ else 'list', schema], universal_newlines=True
+                ).replace('\n', '')
         except subprocess.CalledProcessError:
             return False
 
@@ -140,10 +154,12 @@ class StaticMethods:
         :param schema:
         :return: output: str if successful else False
         """
+        StaticMethods.dconf_invalidate_snapshots(schema)
         try:
-            return subprocess.check_output(
-                ['dconf', 'reset', '-f', schema], universal_newlines=True
-            ).replace('\n', '')
+            with RunStats.command(['dconf', 'reset', '-f', schema]):
+                return subprocess.check_output(
+                    ['dconf', 'reset', '-f', schema], universal_newlines=True
+                ).replace('\n', '')
         except subprocess.CalledProcessError:
             return False
 
@@ -156,6 +172,8 @@ class StaticMethods:
         :param value: value for write
         :return: executed command: str if successful else 1
         """
+        StaticMethods.dconf_invalidate_snapshots(schema)
+        started = time.monotonic()
         proc = subprocess.Popen(
             ['dconf', 'write', schema, value],
             stdout=subprocess.PIPE,
@@ -164,6 +182,7 @@ class StaticMethods:
 
         try:
             proc.wait(3)
+            RunStats.record_command(['dconf', 'write', schema], started, time.monotonic())
             return_cmd = 'dconf write {0} "{1}"'.format(schema, value)
             if proc.returncode != 0:
                 print("Err:", return_cmd)
@@ -173,24 +192,115 @@ class StaticMethods:
             return 1
 
     @staticmethod
-    def backup_file(file: str, time_postfix: bool = None):
+    def dconf_load_command(schema: str, keyfile: str, timeout: float = 30):
         """
-        Backup file with permissions (near)
-        :param file: full path to the file
-        :param time_postfix: whether to add time postfix
-        :return: the path where the file was saved
+        Load data into dconf with a single 'dconf load' (instead of a sequence of 'dconf write')
+        :param schema: dir schema (ends with '/')
+        :param keyfile: data in 'dconf dump' format
+        :return: True if successful else False
+        """
+        StaticMethods.dconf_invalidate_snapshots(schema)
+        proc = subprocess.Popen(
+            ['dconf', 'load', schema],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        try:
+            with RunStats.command(['dconf', 'load', schema]):
+                (stdout, stderr) = proc.communicate(keyfile, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            print("Err: dconf load %s (timeout)" % schema)
+            return False
+        if proc.returncode != 0:
+            print("Err: dconf load %s" % schema)
+            print("stderr: ", stderr)
+            return False
+        return True
+
+    @staticmethod
+    def dconf_dump_command(schema: str):
+        """
+        Get a dump of the dconf dir
+        :param schema: dir schema (ends with '/')
+        :return: output: str if successful else False
+        """
+        try:
+            with RunStats.command(['dconf', 'dump', schema]):
+                return subprocess.check_output(['dconf', 'dump', schema], universal_newlines=True)
+        except subprocess.CalledProcessError:
+            return False
+
+    @staticmethod
+    def dconf_snapshot(schema: str):
+        """
+        Cached 'dconf dump' of the dir. Only one subprocess until our own writes to the dir
+        (dconf_write_command, dconf_reset_command, dconf_load_command invalidate it)
+        :param schema: dir schema (ends with '/')
+        :return: see parse_dconf_keyfile. Don't modify it!
+        :rtype: dict
+        """
+        if schema not in StaticMethods.DCONF_SNAPSHOTS:
+            dump = StaticMethods.dconf_dump_command(schema)
+            StaticMethods.DCONF_SNAPSHOTS[schema] = StaticMethods.parse_dconf_keyfile(dump) if dump else {}
+        return StaticMethods.DCONF_SNAPSHOTS[schema]
+
+    @staticmethod
+    def dconf_invalidate_snapshots(schema: str):
+        """ Forget snapshots that overlap with the schema (key or dir) """
+        for cached in list(StaticMethods.DCONF_SNAPSHOTS.keys()):
+            if schema.startswith(cached) or cached.startswith(schema):
+                StaticMethods.DCONF_SNAPSHOTS.pop(cached, None)  # may be called from several threads
+
+    @staticmethod
+    def dconf_snapshot_read(schema: str, relative_key: str):
+        """
+        Analog of dconf_read_command served from dconf_snapshot
+        :param schema: dir schema (ends with '/')
+        :param relative_key: 'profile0/title' for example
+        :return: output: str ('' if the key is not set)
+        """
+        section, _, key = relative_key.rpartition('/')
+        return StaticMethods.dconf_snapshot(schema).get(section if section else '/', {}).get(key, '')
+
+    @staticmethod
+    def parse_dconf_keyfile(data: str):
+        """
+        Parse data in 'dconf dump' format
+        :return: dict(relative_dir = dict(key = value, ...), ...). Keys of the dumped dir itself are in '/'
+        :rtype: dict
+        """
+        keyfile = {}
+        section = None
+        for line in data.splitlines():
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line[0] + line[-1] == '[]':
+                section = keyfile.setdefault(line[1:-1], {})
+            elif section is not None and '=' in line:
+                key, value = line.split('=', 1)
+                section[key] = value
+        return keyfile
+
+    @staticmethod
+    def build_dconf_keyfile(keyfile: dict):
+        """
+        Reverse of parse_dconf_keyfile. Empty values are skipped ('dconf load' fails on them)
+        :param keyfile: dict(relative_dir = dict(key = value, ...), ...)
         :rtype: str
         """
-        time_postfix = StaticMethods.TIME_POSTFIX if time_postfix is None else time_postfix
-        if os.path.isfile(file):
-            if time_postfix:
-                save_to = StaticMethods.get_name_with_time_postfix(file) + '.bak'
-            else:
-                save_to = file + '.bak'
-            shutil.copy2(file, save_to)
-            st = os.stat(file)
-            os.chown(save_to, st.st_uid, st.st_gid)
-            return save_to
+        data = []
+        for section, values in keyfile.items():
+            data.append('[%s]' % section)
+            for key, value in values.items():
+                if value:
+                    data.append('%s=%s' % (key, value))
+            data.append('')
+        return '\n'.join(data)
 
     @staticmethod
     def read_file(input_file: str, mode='r'):
@@ -204,6 +314,136 @@ class StaticMethods:
         except:
             raise Exception('Failed to load %s!' % input_file)
 
+    @staticmethod
+    def read_json(input_file: str, default=None):
+        """
+        Read json file. Unlike read_file, doesn't throw an exception
+        :return: data or default if the file doesn't exist or is damaged
+        """
+        try:
+            with open(input_file, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return default
+
+    @staticmethod
+    def get_public_key_fingerprint(public_key: str):
+        """
+        SHA256 fingerprint of the public key (same as 'ssh-keygen -lf', but without subprocess)
+        :param public_key: path to the public key
+        :return: 'SHA256:...' or None if the key can't be read
+        """
+        try:
+            blob = base64.b64decode(StaticMethods.read_file(public_key).split()[1])
+        except Exception:
+            return None
+        return 'SHA256:' + base64.b64encode(hashlib.sha256(blob).digest()).decode().rstrip('=')
+
+    @staticmethod
+    def tcp_connect_latencies(addresses: dict, timeout: float = 3, parallel: int = 256):
+        """
+        Concurrently open non-blocking TCP connections (one selector loop, without a thread per address)
+        :param addresses: dict(key = (host, port), ...)
+        :param timeout: time limit for each connection
+        :param parallel: how many connections can be in progress at the same time
+        :return: dict(key = connect time in seconds or None if the address is unreachable, ...)
+        """
+        def resolve(address):
+            try:
+                return socket.getaddrinfo(address[0], int(address[1]), type=socket.SOCK_STREAM)[0]
+            except (socket.gaierror, ValueError, OSError):
+                return None
+
+        keys = list(addresses.keys())
+        with ThreadPoolExecutor(max_workers=32) as executor:  # DNS can't be asked without blocking
+            resolved = dict(zip(keys, executor.map(resolve, [addresses[key] for key in keys])))
+
+        latencies = {key: None for key in keys}
+        pending = [key for key in reversed(keys) if resolved[key] is not None]
+        selector = selectors.DefaultSelector()
+        try:
+            while pending or selector.get_map():
+                while pending and len(selector.get_map()) < parallel:
+                    key = pending.pop()
+                    family, type_, proto, _, sockaddr = resolved[key]
+                    sock = socket.socket(family, type_, proto)
+                    sock.setblocking(False)
+                    if sock.connect_ex(sockaddr) not in (0, errno.EINPROGRESS):
+                        sock.close()
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE, (key, time.monotonic()))
+
+                if not selector.get_map():  # all of them have failed immediately
+                    continue
+                now = time.monotonic()
+                wait = min(started for _, started in
+                           [selector_key.data for selector_key in selector.get_map().values()]) + timeout - now
+                for selector_key, _ in selector.select(max(wait, 0)):
+                    key, started = selector_key.data
+                    if selector_key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        latencies[key] = time.monotonic() - started
+                    selector.unregister(selector_key.fileobj)
+                    selector_key.fileobj.close()
+
+                now = time.monotonic()
+                for selector_key in list(selector.get_map().values()):
+                    if selector_key.data[1] + timeout <= now:
+                        selector.unregister(selector_key.fileobj)
+                        selector_key.fileobj.close()
+        finally:
+            for selector_key in list(selector.get_map().values()):
+                selector_key.fileobj.close()
+            selector.close()
+        return latencies
+
+    @staticmethod
+    def known_hosts_name(ip: str, port):
+        """ How the host is written in known_hosts: 'ip' or '[ip]:port' """
+        return ip if str(port) == '22' else '[%s]:%s' % (ip, port)
+
+    @staticmethod
+    def hash_known_hosts_name(name: str, salt: bytes = None):
+        """ Same as 'ssh-keygen -H': |1|base64(salt)|base64(HMAC-SHA1(salt, name)) """
+        salt = os.urandom(20) if salt is None else salt
+        digest = hmac.new(salt, name.encode(), hashlib.sha1).digest()
+        return '|1|%s|%s' % (base64.b64encode(salt).decode(), base64.b64encode(digest).decode())
+
+    @staticmethod
+    def parse_known_hosts(data: str):
+        """
+        :return: list of (list of host patterns, key type, key); lines with markers (@revoked...) are skipped
+        """
+        entries = []
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or fields[0].startswith('#') or fields[0].startswith('@'):
+                continue
+            entries.append((fields[0].split(','), fields[1], fields[2]))
+        return entries
+
+    @staticmethod
+    def known_hosts_keys(entries: list, name: str):
+        """
+        :param entries: see parse_known_hosts
+        :param name: see known_hosts_name
+        :return: set of (key type, key) of the host (hashed names are checked too)
+        """
+        keys = set()
+        for patterns, key_type, key in entries:
+            for pattern in patterns:
+                if pattern.startswith('|1|'):
+                    try:
+                        salt = base64.b64decode(pattern.split('|')[2])
+                    except Exception:
+                        continue
+                    matched = StaticMethods.hash_known_hosts_name(name, salt) == pattern
+                else:
+                    matched = pattern == name
+                if matched:
+                    keys.add((key_type, key))
+                    break
+        return keys
+
     @staticmethod
     def delete_newlines(data: str):
         """ Replace 2 or more consecutive newlines with 2 newlines """
@@ -213,39 +453,425 @@ class StaticMethods:
     @staticmethod
     def run_popen(command_list, timeout: float = 60):
         """
-        Execute a child program in a new process
+        Execute a child program in a new process. Pipes are read while waiting (a child with a lot of output
+        doesn't block), on timeout the child and its descendants (process group) are killed and reaped
         :return: returncode or 1 if failed, stdout: str, stderr: str
         """
+        started = time.monotonic()
         proc = subprocess.Popen(command_list,
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                stdin=subprocess.PIPE, universal_newlines=True)
+                                stdin=subprocess.DEVNULL, universal_newlines=True,
+                                start_new_session=True)
         try:
-            proc.wait(timeout)
-            stdout, stderr = proc.communicate()
+            return StaticMethods._communicate(proc, command_list, timeout)
+        finally:
+            RunStats.record_command(command_list, started, time.monotonic())
+
+    @staticmethod
+    def _communicate(proc: subprocess.Popen, command_list, timeout: float):
+        """ See run_popen """
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
             return proc.returncode, stdout, stderr
         except subprocess.TimeoutExpired as Err:
-            return 1, '', str(Err) + '\n'
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            try:  # what was written before the timeout
+                stdout, stderr = proc.communicate(timeout=5)
+            except subprocess.TimeoutExpired:  # the pipes are held by a process outside of the group
+                proc.kill()
+                stdout, stderr = '', ''
+                proc.wait()
+            return 1, stdout or '', (stderr or '') + str(Err) + '\n'
+
+
+class RunStats:
+    """
+    Timing of phases and accounting of subprocesses (--stats, --trace). Does nothing until enabled
+    """
+    enabled: bool = False
+    lock = threading.Lock()
+    origin: float = time.monotonic()
+    phases: list = []  # (name, started, finished)
+    commands: dict = {}  # command type -> [count, total time, max time]
+    hosts: dict = {}  # user@ip -> [count, total time]
+    events: list = []  # (command type, host, started, finished, thread)
+    WRAPPERS: tuple = ('sshpass', 'expect', 'expect.exp')
+
+    @staticmethod
+    @contextmanager
+    def phase(name: str):
+        """ with RunStats.phase('name'): ... """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            if RunStats.enabled:
+                with RunStats.lock:
+                    RunStats.phases.append((name, started, time.monotonic()))
+
+    @staticmethod
+    @contextmanager
+    def command(command_list: list):
+        """ with RunStats.command(command_list): subprocess... """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            RunStats.record_command(command_list, started, time.monotonic())
+
+    @staticmethod
+    def command_type(command_list: list):
+        """
+        ['dconf', 'load', ...] -> 'dconf load', ['sshpass', '-p', '***', 'ssh-copy-id', ...] -> 'sshpass ssh-copy-id'
+        :rtype: str
+        """
+        name = os.path.basename(command_list[0])
+        if name == 'dconf' and len(command_list) > 1:
+            return 'dconf ' + command_list[1]
+        if name in RunStats.WRAPPERS and len(command_list) > 2:
+            index = 3 if name == 'sshpass' else 2  # sshpass -p PASSWORD cmd / expect.exp PASSWORD cmd
+            return name + ' ' + RunStats.command_type(command_list[index:])
+        if name == 'ssh' and '-G' in command_list:
+            return 'ssh -G'
+        return name
+
+    @staticmethod
+    def record_command(command_list: list, started: float, finished: float):
+        """ For subprocesses that are not started through RunStats.command (see PtyPasswordDriver) """
+        if not RunStats.enabled:
+            return
+        command_type = RunStats.command_type(command_list)
+        host = ([arg for arg in command_list if '@' in arg and not arg.startswith('-')] or [None])[-1]
+        duration = finished - started
+        with RunStats.lock:
+            stat = RunStats.commands.setdefault(command_type, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] = max(stat[2], duration)
+            if host is not None:
+                stat = RunStats.hosts.setdefault(host, [0, 0.0])
+                stat[0] += 1
+                stat[1] += duration
+            RunStats.events.append((command_type, host, started, finished, threading.get_ident()))
+
+    @staticmethod
+    def summary(top_hosts: int = 10):
+        """
+        :param top_hosts: how many hosts with the longest total time of subprocesses to show
+        :return: text tables
+        :rtype: str
+        """
+        lines = ['', '*** STATS: ***', '%-40s %10s' % ('Phase', 'Time, s')]
+        for name, started, finished in sorted(RunStats.phases, key=lambda phase: phase[1]):
+            lines.append('%-40s %10.3f' % (name, finished - started))
+        lines += ['', '%-40s %8s %10s %10s' % ('Command', 'Count', 'Total, s', 'Max, s')]
+        for command_type, (count, total, max_) in sorted(RunStats.commands.items(), key=lambda item: -item[1][1]):
+            lines.append('%-40s %8d %10.3f %10.3f' % (command_type, count, total, max_))
+        lines.append('%-40s %8d' % ('All subprocesses', sum(stat[0] for stat in RunStats.commands.values())))
+        if RunStats.hosts:
+            lines += ['', '%-40s %8s %10s' % ('Host (top %d)' % top_hosts, 'Count', 'Total, s')]
+            for host, (count, total) in sorted(RunStats.hosts.items(), key=lambda item: -item[1][1])[:top_hosts]:
+                lines.append('%-40s %8d %10.3f' % (host, count, total))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def save_trace(trace_file: str):
+        """
+        Chrome trace event format (chrome://tracing, https://ui.perfetto.dev): phases in the first row,
+        subprocesses in rows without overlaps
+        :return: the path where the file was saved
+        """
+        to_us = lambda seconds: round((seconds - RunStats.origin) * 1000000)
+        events = []
+        for name, started, finished in RunStats.phases:
+            events.append(dict(name=name, cat='phase', ph='X', pid=1, tid=0,
+                               ts=to_us(started), dur=to_us(finished) - to_us(started)))
+        lanes = []  # finish time of the last subprocess of each row
+        for command_type, host, started, finished, thread in sorted(RunStats.events, key=lambda event: event[2]):
+            lane = next((index for index, busy_until in enumerate(lanes) if busy_until <= started), len(lanes))
+            lanes[lane:lane + 1] = [finished]
+            events.append(dict(name=command_type, cat='subprocess', ph='X', pid=1, tid=lane + 1,
+                               ts=to_us(started), dur=to_us(finished) - to_us(started),
+                               args=dict(host=host, thread=thread)))
+        events.append(dict(name='thread_name', ph='M', pid=1, tid=0, args=dict(name='phases')))
+        return StaticMethods.save_file(trace_file, json.dumps(dict(traceEvents=events, displayTimeUnit='ms')),
+                                       time_postfix=False)
+
+
+class PhaseRunner:
+    """
+    Runs independent phases (for example, dconf and ssh) at the same time. Output of the first phase
+    is shown as is, output of the others is shown as one block when the phase is finished.
+    While running, it replaces sys.stdout
+    """
+
+    def __init__(self):
+        self.stdout = sys.stdout
+        self.lock = threading.Lock()
+        self.buffers = {}  # thread ident -> buffered output of the phase
+        self.partial = {}  # thread ident -> not finished line of the live phase
+
+    def run(self, phases: list):
+        """
+        The first phase runs in the calling thread (so Ctrl-C interrupts it), the others in their own threads
+        :param phases: list of (name, func without arguments); exceptions are raised when all phases are finished
+        """
+        errors = []
+        sys.stdout = self
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(phases) - 1, 1)) as executor:
+                futures = [executor.submit(self._run_phase, name, func, True) for name, func in phases[1:]]
+                try:
+                    if phases:
+                        self._run_phase(phases[0][0], phases[0][1], False)
+                except Exception as Err:
+                    errors.append(Err)
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as Err:
+                        errors.append(Err)
+        finally:
+            sys.stdout = self.stdout
+        if errors:
+            raise errors[0]
+
+    def _run_phase(self, name: str, func, buffered: bool):
+        ident = threading.get_ident()
+        if buffered:
+            self.buffers[ident] = []
+        try:
+            with RunStats.phase(name):
+                func()
+        finally:
+            with self.lock:
+                self.stdout.write(''.join(self.buffers.pop(ident, [])) + self.partial.pop(ident, ''))
+                self.stdout.flush()
+
+    def write(self, data: str):
+        ident = threading.get_ident()
+        if ident in self.buffers:
+            self.buffers[ident].append(data)
+            return len(data)
+        # only whole lines, so that a block of another phase doesn't get into the middle of a line
+        lines, newline, rest = (self.partial.pop(ident, '') + data).rpartition('\n')
+        if rest:
+            self.partial[ident] = rest
+        if newline:
+            with self.lock:
+                self.stdout.write(lines + newline)
+        return len(data)
+
+    def flush(self):
+        with self.lock:
+            self.stdout.flush()
+
+    def isatty(self):
+        return self.stdout.isatty()
+
+
+class TrackingFileSystemLoader(FileSystemLoader):
+    """ FileSystemLoader that remembers which files were loaded (the main yml and everything it includes) """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loaded_files = []
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        self.loaded_files.append(filename)
+        return source, filename, uptodate
 
 
 class SpecificMethods:
     """ Specific program functions """
+    CACHE_DIR: str = os.path.join(SCRIPT_DIR, 'cache')
+    CACHE_VERSION: int = 2  # increase if read_yml starts to return something else
+    YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # LibYAML, if pyyaml is built with it
+    REFERENCE = re.compile(r'^\s*\{\{\s*([A-Za-z_]\w*(?:\.\w+)*)\s*\}\}\s*$')  # "{{ keys.ecdsa }}"
+    TEMPLATE_MARKERS: tuple = ('{{', '{%', '{#')
 
     @staticmethod
-    def read_yml(yml_file: str):
+    def read_yml(yml_file: str, use_cache: bool = True):
         """
-        Specific reading of the main yaml config for it program
+        Specific reading of the main yaml config for it program.
+        The result is cached (pickle in CACHE_DIR) until the yml or the templates it includes change
+        :param yml_file: yml file or directory with fragments (see read_yml_dir)
+        :rtype: dict
+        """
+        if os.path.isdir(yml_file):
+            return SpecificMethods.read_yml_dir(yml_file, use_cache)
+
+        cache_file = SpecificMethods.get_inventory_cache_path('inventory', yml_file)
+        if use_cache:
+            yaml_data = SpecificMethods.read_inventory_cache(cache_file)
+            if yaml_data is not None:
+                return yaml_data
+
+        yaml_data, loaded_files = SpecificMethods._read_yml(yml_file)
+        if use_cache:
+            SpecificMethods.save_inventory_cache(cache_file, yaml_data, [yml_file] + loaded_files)
+        return yaml_data
+
+    @staticmethod
+    def read_yml_dir(yml_dir: str, use_cache: bool = True):
+        """
+        Reading of the inventory directory (servers.d/*.yml, per team/datacenter...): fragments are merged
+        into one config, see merge_yml_fragments. Changed fragments are parsed in parallel,
+        each fragment has its own cache. References are resolved after merging
+        :rtype: dict
+        """
+        files = sorted(glob.glob(os.path.join(yml_dir, '*.yml')) + glob.glob(os.path.join(yml_dir, '*.yaml')))
+        if not files:
+            raise Exception("There are no *.yml files in %s!" % yml_dir)
+
+        fragments = {}
+        need_parse = []
+        for file in files:
+            fragments[file] = SpecificMethods.read_inventory_cache(
+                SpecificMethods.get_inventory_cache_path('fragment', file)) if use_cache else None
+            if fragments[file] is None:
+                need_parse.append(file)
+
+        if len(need_parse) > 1:
+            with ProcessPoolExecutor(max_workers=min(len(need_parse), os.cpu_count() or 1)) as executor:
+                for file, yaml_data in zip(need_parse, executor.map(SpecificMethods.load_yml, need_parse)):
+                    fragments[file] = yaml_data
+        elif need_parse:
+            fragments[need_parse[0]] = SpecificMethods.load_yml(need_parse[0])
+
+        for file in need_parse:
+            if fragments[file].get('use_jinja', False):
+                raise Exception("\n\nError! 'use_jinja' is not supported in inventory directories (%s)" % file)
+            if use_cache:
+                SpecificMethods.save_inventory_cache(
+                    SpecificMethods.get_inventory_cache_path('fragment', file), fragments[file], [file])
+
+        yaml_data = SpecificMethods.merge_yml_fragments([(file, fragments[file]) for file in files])
+        return SpecificMethods.resolve_references(yaml_data, yml_dir)
+
+    @staticmethod
+    def merge_yml_fragments(fragments: list):
+        """
+        Merge fragments of the inventory. Servers (dict_of_servers) must be unique. Other dictionaries
+        (keys, authorization...) are merged, the rest of the values must not contradict each other
+        :param fragments: list of (file, yaml_data)
+        :rtype: dict
+        """
+        servers = {}
+        duplicates = []
+        for file, yaml_data in fragments:
+            if yaml_data.get('dict_of_servers') is None:  # 'dict_of_servers:' with all servers commented out
+                yaml_data['dict_of_servers'] = {}
+            for server in yaml_data['dict_of_servers'].keys():
+                if server in servers:
+                    duplicates.append("'%s' (%s and %s)" % (server, servers[server], file))
+                else:
+                    servers[server] = file
+        if duplicates:
+            raise Exception("\n\nError! Duplicate servers: %s" % ', '.join(duplicates))
+
+        merged = dict(dict_of_servers={})
+        defined_in = {}
+        for file, yaml_data in fragments:
+            for server_dict in yaml_data['dict_of_servers'].values():
+                if isinstance(server_dict, dict):  # the fragment is the default group (see server_group)
+                    server_dict.setdefault('group', os.path.splitext(os.path.basename(file))[0])
+            for key_, value in yaml_data.items():
+                if key_ not in merged:
+                    merged[key_] = dict(value) if isinstance(value, dict) else value
+                    defined_in[key_] = file
+                elif isinstance(merged[key_], dict) and isinstance(value, dict):
+                    for sub_key, sub_value in value.items():
+                        if sub_key in merged[key_] and merged[key_][sub_key] != sub_value:
+                            raise Exception("\n\nError! '%s.%s' is defined differently in %s and %s" % (
+                                key_, sub_key, defined_in[key_], file))
+                        merged[key_][sub_key] = sub_value
+                elif merged[key_] != value:
+                    raise Exception("\n\nError! '%s' is defined differently in %s and %s" % (
+                        key_, defined_in[key_], file))
+        return merged
+
+    @staticmethod
+    def load_yml(yml_file: str):
+        """
+        Plain yaml reading (references are not resolved)
         :rtype: dict
         """
         with open(yml_file, "r") as file:
             try:
-                yaml_data = yaml.safe_load(file)
+                return yaml.load(file, Loader=SpecificMethods.YAML_LOADER) or {}
             except yaml.YAMLError as exc:
                 raise Exception("\n\nError! %s" % exc)
 
-        env = Environment(loader=FileSystemLoader(searchpath=os.path.dirname(yml_file)))
+    @staticmethod
+    def get_inventory_cache_path(prefix: str, yml_file: str):
+        """ Cache file of the yml in CACHE_DIR """
+        return os.path.join(SpecificMethods.CACHE_DIR, '%s_%s.pickle' % (
+            prefix, hashlib.sha1(os.path.abspath(yml_file).encode()).hexdigest()))
+
+    @staticmethod
+    def get_files_signature(files: list):
+        """
+        :return: list of [path, mtime_ns, size] or None if one of the files is unavailable
+        """
+        signature = []
+        for file in files:
+            try:
+                st = os.stat(file)
+            except OSError:
+                return None
+            signature.append([file, st.st_mtime_ns, st.st_size])
+        return signature
+
+    @staticmethod
+    def read_inventory_cache(cache_file: str):
+        """
+        :return: cached result of _read_yml or None if the cache is missing or out of date
+        """
+        try:
+            with open(cache_file, 'rb') as file:
+                cache = pickle.load(file)
+        except Exception:
+            return None
+        if cache.get('version') != SpecificMethods.CACHE_VERSION or \
+                SpecificMethods.get_files_signature([x[0] for x in cache['files']]) != cache['files']:
+            return None
+        return cache['data']
+
+    @staticmethod
+    def save_inventory_cache(cache_file: str, yaml_data: dict, files: list):
+        """ Cache yaml_data, it's valid as long as the files don't change """
+        signature = SpecificMethods.get_files_signature(files)
+        if signature is None:
+            return
+        cache = dict(version=SpecificMethods.CACHE_VERSION, files=signature, data=yaml_data)
+        try:
+            StaticMethods.save_file(cache_file, pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL),
+                                    time_postfix=False, mode='wb', chmod='600')
+        except OSError as exc:  # the cache is optional
+            print("Can't save inventory cache %s: %s" % (cache_file, exc))
+
+    @staticmethod
+    def _read_yml(yml_file: str):
+        """
+        Reading of the yml without cache. References like "{{ keys.ecdsa }}" are resolved in one pass
+        over the loaded tree. Jinja rendering is used only if the yml contains 'use_jinja: true'
+        :return: yaml_data: dict, loaded_files: list of templates included by the yml
+        """
+        yaml_data = SpecificMethods.load_yml(yml_file)
+        if not yaml_data.get('use_jinja', False):
+            SpecificMethods.resolve_references(yaml_data, yml_file)
+            return yaml_data, []
+
+        loader = TrackingFileSystemLoader(searchpath=os.path.dirname(yml_file))
+        env = Environment(loader=loader)
         env.filters['path_join'] = lambda x: os.path.join(*x)
         template = env.get_template(os.path.basename(yml_file))
-        yaml_data = yaml.safe_load(template.render(yaml_data))
+        yaml_data = yaml.load(template.render(yaml_data), Loader=SpecificMethods.YAML_LOADER)
 
         for server in yaml_data['dict_of_servers'].keys():
             # binding for proper references to other dictionaries
@@ -257,6 +883,49 @@ class SpecificMethods:
             value = yaml_data[key_]
             if isinstance(value, str) and (value[0] + value[-1] in ['{}', '[]']):
                 yaml_data[key_] = literal_eval(value)
+        return yaml_data, [x for x in loader.loaded_files if os.path.abspath(x) != os.path.abspath(yml_file)]
+
+    @staticmethod
+    def resolve_references(yaml_data: dict, yml_file: str = 'yml'):
+        """
+        Replace strings like "{{ keys.ecdsa }}" with the objects they refer to.
+        The referenced object is shared, not copied. Raise Exception if the reference is undefined
+        or the string needs real templating (then 'use_jinja: true' must be specified in the yml)
+        """
+        resolved = set()  # id() of containers that have already been walked
+        resolving = []  # chain of references, to detect loops
+
+        def lookup(path: str):
+            if path in resolving:
+                raise Exception("\n\nError! Reference loop in %s: %s" % (yml_file, ' -> '.join(resolving + [path])))
+            resolving.append(path)
+            node = yaml_data
+            for part in path.split('.'):
+                if isinstance(node, dict) and part in node:
+                    node = node[part]
+                elif isinstance(node, list) and part.isdigit() and int(part) < len(node):
+                    node = node[int(part)]
+                else:
+                    raise Exception("\n\nError! Undefined reference '{{ %s }}' in %s" % (path, yml_file))
+                node = resolve(node)
+            resolving.pop()
+            return node
+
+        def resolve(node):
+            if isinstance(node, str):
+                match = SpecificMethods.REFERENCE.match(node)
+                if match:
+                    return lookup(match.group(1))
+                if any(marker in node for marker in SpecificMethods.TEMPLATE_MARKERS):
+                    raise Exception("\n\nError! '%s' in %s needs templating. Add 'use_jinja: true' to %s" % (
+                        node, yml_file, yml_file))
+            elif isinstance(node, (dict, list)) and id(node) not in resolved:
+                resolved.add(id(node))
+                for key_ in node.keys() if isinstance(node, dict) else range(len(node)):
+                    node[key_] = resolve(node[key_])
+            return node
+
+        resolve(yaml_data)
         return yaml_data
 
     @staticmethod
@@ -281,11 +950,21 @@ class SpecificMethods:
                 i_want_skeep.append(server)
         return i_want_skeep
 
+    @staticmethod
+    def server_group(yml_dict: dict, server: str):
+        """
+        Group of the server: 'group' field of the server, or the name of the inventory fragment
+        (see merge_yml_fragments), or 'default'
+        :rtype: str
+        """
+        server_dict = yml_dict['dict_of_servers'].get(server) or {}
+        return server_dict.get('group', 'default')
+
     @staticmethod
     def server_info(yml_dict: dict, server: str):
         """
         For comfort func
-        :return: dict(User, Password, IP, Port, AuthorizationFile, IdentityFile)"""
+        :return: dict(User, Password, IP, Port, AuthorizationFile, IdentityFile, ProxyJump)"""
         server_dict = yml_dict['dict_of_servers'][server]
         user = server_dict['authorization']['username']
         password = server_dict['authorization']['password']
@@ -295,13 +974,280 @@ class SpecificMethods:
         private_key = os.path.expanduser(server_dict['keys']['private_key'])
         return dict(
             User=user, Password=password, IP=ip, Port=port,
-            AuthorizationFile=public_key, IdentityFile=private_key
+            AuthorizationFile=public_key, IdentityFile=private_key,
+            ProxyJump=SpecificMethods.server_proxy_jump(yml_dict, server),
         )
 
+    @staticmethod
+    def server_proxy_jump(yml_dict: dict, server: str):
+        """
+        Jump host of the server: 'proxy_jump' field of the server (empty - connect directly), or
+        proxy_jump_of_groups[group of the server] (see server_group)
+        :return: 'name of a server or [user@]host[:port]', several separated by ',' or None
+        """
+        server_dict = yml_dict['dict_of_servers'][server]
+        if 'proxy_jump' in server_dict:
+            proxy_jump = server_dict['proxy_jump']
+        else:
+            proxy_jump = (yml_dict.get('proxy_jump_of_groups') or {}).get(
+                SpecificMethods.server_group(yml_dict, server))
+        return str(proxy_jump) if proxy_jump else None
+
+
+class InventoryIndex:
+    """
+    Index of servers that I want to add (i_want_add) for --only/--exclude: sorted names (exact names
+    and globs with a literal prefix are found by binary search), tags, groups and sorted addresses (CIDR).
+    Selectors:
+        name, glob (web-*), re:REGEX, tag:TAG ('tags' of the server), group:GROUP (see server_group),
+        IP or network (10.0.0.0/24)
+    """
+    GLOB_CHARS = re.compile(r'[*?\[]')
+
+    def __init__(self, yml_dict: dict):
+        self.names = sorted(SpecificMethods.i_want_add(yml_dict))
+        self.by_tag = {}
+        self.by_group = {}
+        self.addresses = {4: [], 6: []}  # IP version -> sorted [(int(ip), server), ...]
+        for server in self.names:
+            server_dict = yml_dict['dict_of_servers'][server]
+            tags = server_dict.get('tags') or []
+            for tag in [tags] if isinstance(tags, str) else tags:
+                self.by_tag.setdefault(str(tag), set()).add(server)
+            self.by_group.setdefault(SpecificMethods.server_group(yml_dict, server), set()).add(server)
+            try:
+                ip = ipaddress.ip_address(str(server_dict['ip']))
+            except ValueError:  # a host name
+                continue
+            self.addresses[ip.version].append((int(ip), server))
+        for addresses in self.addresses.values():
+            addresses.sort()
+
+    def select(self, only: list = None, exclude: list = None):
+        """
+        :param only: selectors; if empty, all servers
+        :param exclude: selectors
+        :return: sorted list of servers
+        """
+        selected = set().union(*[self.match(selector) for selector in only]) if only else set(self.names)
+        for selector in exclude or []:
+            selected -= self.match(selector)
+        return sorted(selected)
+
+    def match(self, selector: str):
+        """
+        :return: set of servers
+        """
+        if selector.startswith('tag:'):
+            return set(self.by_tag.get(selector[4:], set()))
+        if selector.startswith('group:'):
+            return set(self.by_group.get(selector[6:], set()))
+        if selector.startswith('re:'):
+            pattern = re.compile(selector[3:])
+            return {server for server in self.names if pattern.search(server)}
+        try:
+            network = ipaddress.ip_network(selector, strict=False)
+        except ValueError:
+            return self.match_glob(selector)
+        addresses = self.addresses[network.version]
+        start = bisect.bisect_left(addresses, (int(network.network_address), ''))
+        end = bisect.bisect_right(addresses, (int(network.broadcast_address), chr(0x10FFFF)))
+        return {server for _, server in addresses[start:end]}
+
+    def match_glob(self, pattern: str):
+        """ Only names with the literal prefix of the pattern are checked """
+        glob_char = self.GLOB_CHARS.search(pattern)
+        prefix = pattern if glob_char is None else pattern[:glob_char.start()]
+        start = bisect.bisect_left(self.names, prefix)
+        if glob_char is None:
+            return {pattern} if self.names[start:start + 1] == [pattern] else set()
+        matched = set()
+        for server in self.names[start:]:
+            if not server.startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(server, pattern):
+                matched.add(server)
+        return matched
+
+
+class IncrementalState:
+    """
+    Hashes of server records applied by previous runs (json file near the script).
+    With --incremental only servers whose record has changed are processed
+    """
+    save_dir: str = SCRIPT_DIR
+
+    def __init__(self, section: str, save_dir: str = None):
+        """
+        :param section: independent part of the state, each in its own file ('dconf', 'ssh_config', ...)
+        """
+        self.save_dir = self.save_dir if not save_dir else save_dir
+        self.state_file = os.path.join(self.save_dir, 'state_%s.json' % section)
+        self.hashes = StaticMethods.read_json(self.state_file, default={})
+
+    @staticmethod
+    def get_hash(record):
+        """ Content hash of the record (any json-serializable object) """
+        return hashlib.sha256(json.dumps(record, sort_keys=True, default=str).encode()).hexdigest()
+
+    def changed(self, server: str, record):
+        """ Whether the record differs from the one applied last time (or was never applied) """
+        return self.hashes.get(server) != self.get_hash(record)
+
+    def update(self, server: str, record):
+        """ The record has been applied """
+        self.hashes[server] = self.get_hash(record)
+
+    def forget(self, server: str):
+        """ The record has been removed """
+        self.hashes.pop(server, None)
+
+    def servers(self):
+        """
+        Servers applied by previous runs
+        :rtype: list of str
+        """
+        return list(self.hashes.keys())
+
+    def save(self):
+        StaticMethods.save_file(self.state_file, json.dumps(self.hashes, indent=1, sort_keys=True),
+                                time_postfix=False)
+
+
+class BackupStore:
+    """
+    Snapshots of what ok_ssh changes: the ssh config with its fragments ('ssh'), the dconf branches of
+    the terminal ('dconf'). A file is stored once, compressed and named by the hash of its content
+    (objects/ab/abcd....gz), snapshots in snapshots.json refer to them. A snapshot identical to the
+    previous one of the same kind is not made. Old snapshots are deleted by count and age (the last one
+    of each kind is always kept), then objects that are not referred to
+    """
+    store_dir: str = os.path.join(SCRIPT_DIR, 'backups')
+
+    def __init__(self, store_dir: str = None, keep: int = None, max_age: float = None):
+        """
+        :param keep: how many snapshots of each kind to keep (None - all)
+        :param max_age: delete snapshots older than max_age days (None - never)
+        """
+        self.store_dir = self.store_dir if not store_dir else store_dir
+        self.objects_dir = os.path.join(self.store_dir, 'objects')
+        self.index_file = os.path.join(self.store_dir, 'snapshots.json')
+        self.keep = keep
+        self.max_age = max_age
+
+    def snapshots(self):
+        """
+        :return: list of dict(id, time, kind, items = dict(name = hash or None if absent), size), oldest first
+        """
+        return StaticMethods.read_json(self.index_file, default=[])
+
+    def object_path(self, hash_: str):
+        return os.path.join(self.objects_dir, hash_[:2], hash_ + '.gz')
+
+    def put_object(self, data: bytes):
+        """ :return: hash of the content (the object is written only if there is no such one yet) """
+        hash_ = hashlib.sha256(data).hexdigest()
+        if not os.path.isfile(self.object_path(hash_)):
+            StaticMethods.write_file_atomically(self.object_path(hash_), gzip.compress(data))
+        return hash_
+
+    def get_object(self, hash_: str):
+        """ :rtype: bytes """
+        return gzip.decompress(StaticMethods.read_file(self.object_path(hash_), mode='rb'))
+
+    def save(self, kind: str, items: dict):
+        """
+        Make a snapshot
+        :param kind: 'ssh', 'dconf'...
+        :param items: dict(name = content: bytes or None if absent, ...), name is a path of the file or
+            'dconf:SCHEMA'
+        :return: the snapshot and whether it is new (False - the previous one is the same)
+        :rtype: tuple
+        """
+        snapshots = self.snapshots()
+        hashes = {name: None if data is None else self.put_object(data) for name, data in items.items()}
+        previous = [snapshot for snapshot in snapshots if snapshot['kind'] == kind]
+        new = not previous or previous[-1]['items'] != hashes
+        if new:
+            now = datetime.now()
+            snapshot_id = now.strftime('%Y%m%d-%H%M%S-') + kind
+            ids = {snapshot['id'] for snapshot in snapshots}
+            suffix = 1
+            while snapshot_id in ids:  # several runs in a second
+                snapshot_id = now.strftime('%Y%m%d-%H%M%S-') + kind + '.%d' % suffix
+                suffix += 1
+            snapshot = dict(id=snapshot_id, time=now.isoformat(timespec='seconds'), kind=kind, items=hashes,
+                            size=sum(len(data) for data in items.values() if data is not None))
+            snapshots.append(snapshot)
+        else:
+            snapshot = previous[-1]
+
+        kept = self.prune(snapshots)
+        if new or len(kept) != len(snapshots):
+            self.write_index(kept)
+        return snapshot, new
+
+    def prune(self, snapshots: list):
+        """
+        Delete snapshots beyond self.keep / older than self.max_age and unreferenced objects
+        :return: the rest of snapshots
+        :rtype: list
+        """
+        min_time = None if self.max_age is None else \
+            (datetime.now() - timedelta(days=self.max_age)).isoformat(timespec='seconds')
+        kept = []
+        for kind in sorted({snapshot['kind'] for snapshot in snapshots}):
+            of_kind = [snapshot for snapshot in snapshots if snapshot['kind'] == kind]
+            newest_first = list(reversed(of_kind))
+            kept += newest_first[:1] + [
+                snapshot for index, snapshot in enumerate(newest_first[1:], 1)
+                if (self.keep is None or index < self.keep) and (min_time is None or snapshot['time'] >= min_time)
+            ]
+        kept = [snapshot for snapshot in snapshots if snapshot in kept]  # original order
+
+        referenced = {hash_ for snapshot in kept for hash_ in snapshot['items'].values() if hash_}
+        for path in glob.glob(os.path.join(self.objects_dir, '*', '*.gz')):
+            if os.path.basename(path)[:-len('.gz')] not in referenced:
+                os.remove(path)
+        return kept
+
+    def write_index(self, snapshots: list):
+        StaticMethods.write_file_atomically(self.index_file, json.dumps(snapshots, indent=1))
+
+    def find(self, snapshot_id: str = None, kind: str = None):
+        """
+        :param snapshot_id: None - the last snapshot (of the kind, if given)
+        :return: the snapshot or None
+        """
+        for snapshot in reversed(self.snapshots()):
+            if (snapshot_id is None or snapshot['id'] == snapshot_id) and (kind is None or snapshot['kind'] == kind):
+                return snapshot
+        return None
+
+    def describe(self):
+        """ Table of snapshots for --list_backups """
+        snapshots = self.snapshots()
+        if not snapshots:
+            return "No backups in '%s'" % self.store_dir
+        lines = ['%-28s %-20s %-6s %6s %10s' % ('ID', 'TIME', 'KIND', 'FILES', 'SIZE, KB')]
+        for snapshot in snapshots:
+            lines.append('%-28s %-20s %-6s %6d %10.1f' % (
+                snapshot['id'], snapshot['time'].replace('T', ' '), snapshot['kind'],
+                len([hash_ for hash_ in snapshot['items'].values() if hash_]), snapshot['size'] / 1024))
+        objects = glob.glob(os.path.join(self.objects_dir, '*', '*.gz'))
+        lines.append("\n%d snapshots, %d stored files (%.1f KB compressed) in '%s'" % (
+            len(snapshots), len(objects), sum(os.path.getsize(path) for path in objects) / 1024, self.store_dir))
+        return '\n'.join(lines)
+
 
 class AnalyzeCliParameters:
     """ Handling command line options """
     DEFAULT_YML_CONFIG = os.path.join(SCRIPT_DIR, 'servers.yml')
+    DEFAULT_JOBS = 10
+    DEFAULT_JOBS_PER_JUMP = 10  # MaxSessions of sshd: sessions over one (multiplexed) connection
+    DEFAULT_CONNECT_TIMEOUT = 3  # seconds
+    DEFAULT_RETRIES = 2
+    DEFAULT_KEEP_BACKUPS = 20
 
     def __init__(self):
         self.parser = argparse.ArgumentParser(
@@ -329,56 +1275,195 @@ class AnalyzeCliParameters:
                  'specified: -d/-s (default=False)',
         )
 
-        self.main_group.add_argument(
-            '-a', '--auto_authorization', action='store_false', default=True, required=False,
-            help='Send keys to servers and log in automatically (default=True, with -a=False)',
+        self.main_group.add_argument(
+            '-a', '--auto_authorization', action='store_false', default=True, required=False,
+            help='Send keys to servers and log in automatically (default=True, with -a=False)',
+        )
+
+        self.extra_group.add_argument(
+            '-y', '--yml_config', nargs=1, type=os.path.expanduser,
+            default=[self.DEFAULT_YML_CONFIG], metavar='FILE',
+            help='Specify main yml config or directory with *.yml fragments of it (default=' +
+                 self.DEFAULT_YML_CONFIG + ')',
+        )
+
+        self.extra_group.add_argument(
+            '--no_inventory_cache', action='store_true', default=False, required=False,
+            help='Don\'t use the cache of the parsed yml config (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '-b', '--base_profile', nargs=1, type=str, required=False, default=None,
+            help='Specify a basic terminal profile (takes precedence over a profile from a file)',
+            metavar='STR',
+        )
+
+        self.extra_group.add_argument(
+            '-c', '--clear_ssh_config', action='store_true', default=False, required=False,
+            help='Before adding profiles, first clear ssh config (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '-n', '--not_backup', action='store_true', default=False, required=False,
+            help='Don\'t make backups (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '-t', '--time_postfix', action='store_true', default=False, required=False,
+            help='Add a time postfix to the restore instructions and the log of sending keys, so they aren\'t '
+                 'overwritten by the next run (backups are named by their ID anyway; default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--keep_backups', nargs=1, type=int, required=False, default=None, metavar='N',
+            help='How many backups of the ssh config and of dconf to keep, '
+                 'identical backups are not made (default=%s)' % self.DEFAULT_KEEP_BACKUPS,
+        )
+
+        self.extra_group.add_argument(
+            '--backups_max_age', nargs=1, type=float, required=False, default=None, metavar='DAYS',
+            help='Delete backups older than DAYS days, the last one is always kept (default - not by age)',
+        )
+
+        self.extra_group.add_argument(
+            '--list_backups', action='store_true', default=False, required=False,
+            help='Show backups and exit (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--restore', nargs='?', type=str, required=False, default=None, const='', metavar='SNAPSHOT',
+            help='Restore the ssh config and dconf (only one of them with -s/-d) from the last backups, '
+                 'or from the last ones whose ID starts with SNAPSHOT, and exit (default - not restored)',
+        )
+
+        self.extra_group.add_argument(
+            '--ssh_config_dest', nargs=1, type=str, required=False, default=None,
+            help='Specify ssh config location (default - reading from yaml)',
+            metavar='STR',
+        )
+
+        self.extra_group.add_argument(
+            '--compact_ssh_config', action='store_true', default=False, required=False,
+            help='Write options shared by several hosts once, in \'Host a b c ...\' blocks (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--verify_ssh_config', action='store_true', default=False, required=False,
+            help='Before writing the compact config, check with \'ssh -G\' that it resolves hosts '
+                 'identically (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--ssh_config_fragments', action='store_true', default=False, required=False,
+            help='Write hosts to one file per group (config.d/ok_ssh_GROUP.conf near the ssh config), '
+                 'the config itself gets only \'Include\' of them (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--control_persist', nargs=1, type=str, required=False, default=None, metavar='TIME',
+            help='Share one connection per host (ControlMaster) between terminal sessions and sending of '
+                 'the key, keep it open for TIME after the last session, e.g. 10m (default - disabled)',
+        )
+
+        self.extra_group.add_argument(
+            '--auto_authorization_method', nargs=1, type=str, required=False, default=None,
+            help='Specify the preferred program that will enter the password when copying the key '
+                 '(pty - built-in, sshpass or expect; default=pty)',
+            metavar='STR',
+        )
+
+        self.extra_group.add_argument(
+            '-i', '--incremental', action='store_true', default=False, required=False,
+            help='Process only servers whose parameters have changed since the last run, '
+                 'plus added/removed ones (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--force_send_keys', action='store_true', default=False, required=False,
+            help='Send keys even to hosts that already accept them (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--scan_host_keys', action='store_true', default=False, required=False,
+            help='Before sending keys, add host keys of all new hosts to known_hosts at once (ssh-keyscan), '
+                 'then connect with strict host key checking (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--hash_known_hosts', action='store_true', default=False, required=False,
+            help='Hash host names added by --scan_host_keys, as \'ssh-keygen -H\' does (default=False)',
+        )
+
+        self.extra_group.add_argument(
+            '--resume', action='store_true', default=False, required=False,
+            help='Continue the interrupted sending of keys: skip hosts that were done by it (default=False)',
         )
 
         self.extra_group.add_argument(
-            '-y', '--yml_config', nargs=1, type=os.path.expanduser,
-            default=self.DEFAULT_YML_CONFIG, metavar='FILE',
-            help='Specify main yml config (default=' + self.DEFAULT_YML_CONFIG + ')',
+            '--connect_timeout', nargs=1, type=float, required=False, default=None, metavar='SEC',
+            help='Before sending keys, check all hosts with a TCP connection at once: unreachable ones are '
+                 'checked again before each retry, the time limit of sending depends on the connection time '
+                 '(0 - don\'t check; default=%s)' % self.DEFAULT_CONNECT_TIMEOUT,
         )
 
         self.extra_group.add_argument(
-            '-b', '--base_profile', nargs=1, type=str, required=False, default=None,
-            help='Specify a basic terminal profile (takes precedence over a profile from a file)',
-            metavar='STR',
+            '--retries', nargs=1, type=int, required=False, default=None, metavar='N',
+            help='How many times to send the key again to hosts that failed because of a transient error '
+                 '(unreachable, timeout), with growing random delays (default=%s)' % self.DEFAULT_RETRIES,
         )
 
         self.extra_group.add_argument(
-            '-c', '--clear_ssh_config', action='store_true', default=False, required=False,
-            help='Before adding profiles, first clear ssh config (default=False)',
+            '--only', nargs='+', type=str, required=False, default=None, metavar='SEL',
+            help='Process only these servers. SEL: name, glob (web-*), re:REGEX, tag:TAG, group:GROUP, '
+                 'IP or network (10.0.0.0/24) (default - all)',
         )
 
         self.extra_group.add_argument(
-            '-n', '--not_backup', action='store_true', default=False, required=False,
-            help='Don\'t make backups (default=False)',
+            '--exclude', nargs='+', type=str, required=False, default=None, metavar='SEL',
+            help='Don\'t process these servers, SEL as in --only (default - none)',
         )
 
         self.extra_group.add_argument(
-            '-t', '--time_postfix', action='store_true', default=False, required=False,
-            help='Add postfix for backup files (default=False)',
+            '--stats', action='store_true', default=False, required=False,
+            help='At the end, show the time of phases and subprocesses by command and by host (default=False)',
         )
 
         self.extra_group.add_argument(
-            '--ssh_config_dest', nargs=1, type=str, required=False, default=None,
-            help='Specify ssh config location (default - reading from yaml)',
-            metavar='STR',
+            '--trace', nargs=1, type=str, required=False, default=None, metavar='FILE',
+            help='Save phases and subprocesses in Chrome trace event format, for chrome://tracing '
+                 'or ui.perfetto.dev (default - not saved)',
         )
 
         self.extra_group.add_argument(
-            '--auto_authorization_method', nargs=1, type=str, required=False, default=None,
-            help='Specify the preferred program that will enter the password when copying the key (sshpass or expect)',
-            metavar='STR',
+            '-j', '--jobs', nargs=1, type=int, required=False, default=None,
+            help='How many hosts to send keys to at the same time (default=%s)' % self.DEFAULT_JOBS,
+            metavar='N',
+        )
+
+        self.extra_group.add_argument(
+            '--jobs_per_jump', nargs=1, type=int, required=False, default=None, metavar='N',
+            help='How many hosts behind the same jump host (proxy_jump) to send keys to at the same time '
+                 '(default=%s)' % self.DEFAULT_JOBS_PER_JUMP,
         )
 
         self.options = self.parser.parse_args(sys.argv[1:])  # parsing options
 
+        self.options.keep_backups = self.DEFAULT_KEEP_BACKUPS if self.options.keep_backups is None \
+            else self.options.keep_backups[0]
+        if self.options.keep_backups < 1:
+            self.get_error('--keep_backups "' + str(self.options.keep_backups) + '" is not correct!')
+        if self.options.backups_max_age is not None:
+            self.options.backups_max_age = self.options.backups_max_age[0]
+            if self.options.backups_max_age < 0:
+                self.get_error('--backups_max_age "' + str(self.options.backups_max_age) + '" is not correct!')
+        if self.options.list_backups or self.options.restore is not None:
+            return  # the rest isn't needed
+
         if not self.options.dconf_actions and not self.options.ssh_config_actions:
             self.get_error('Please use at least one of the options -s/-d')
 
-        if not os.path.isfile(self.options.yml_config):
+        self.options.yml_config = self.options.yml_config[0]
+        if not os.path.isfile(self.options.yml_config) and not os.path.isdir(self.options.yml_config):
             raise Exception("The file {0} does not exist!".format(self.options.yml_config))
         if self.options.reset_and_exit and not StaticMethods.select_yes_or_no(
                 'Reset and exit mode selected. Do you want to continue?',
@@ -393,22 +1478,61 @@ class AnalyzeCliParameters:
             self.options.ssh_config_dest = os.path.expanduser(
                 self.options.ssh_config_dest[0])
 
+        if self.options.control_persist is not None:
+            self.options.control_persist = self.options.control_persist[0]
+            if not re.fullmatch(r'yes|(\d+[smhdwSMHDW]?)+', self.options.control_persist):
+                self.get_error('--control_persist "' + self.options.control_persist + '" is not correct!')
+
+        if self.options.trace is not None:
+            self.options.trace = os.path.expanduser(self.options.trace[0])
+
+        self.options.selected = None  # servers selected by --only/--exclude, see select_servers
+        for selector in (self.options.only or []) + (self.options.exclude or []):
+            if selector.startswith('re:'):
+                try:
+                    re.compile(selector[3:])
+                except re.error as Err:
+                    self.get_error('"' + selector + '" is not correct: ' + str(Err))
+
+        self.options.connect_timeout = self.DEFAULT_CONNECT_TIMEOUT if self.options.connect_timeout is None \
+            else self.options.connect_timeout[0]
+        if self.options.connect_timeout < 0:
+            self.get_error('--connect_timeout "' + str(self.options.connect_timeout) + '" is not correct!')
+
+        self.options.retries = self.DEFAULT_RETRIES if self.options.retries is None else self.options.retries[0]
+        if self.options.retries < 0:
+            self.get_error('--retries "' + str(self.options.retries) + '" is not correct!')
+
+        self.options.jobs = self.DEFAULT_JOBS if self.options.jobs is None else self.options.jobs[0]
+        if self.options.jobs < 1:
+            self.get_error('-j "' + str(self.options.jobs) + '" is not correct!')
+
+        self.options.jobs_per_jump = self.DEFAULT_JOBS_PER_JUMP if self.options.jobs_per_jump is None \
+            else self.options.jobs_per_jump[0]
+        if self.options.jobs_per_jump < 1:
+            self.get_error('--jobs_per_jump "' + str(self.options.jobs_per_jump) + '" is not correct!')
+
         if self.options.auto_authorization:
-            sshpass_exists = os.path.isfile('/usr/bin/sshpass')
-            expect_exists = os.path.isfile('/usr/bin/expect')
-            if not sshpass_exists and not expect_exists:
-                self.get_error(
-                    'Please install sshpass or expect for automatic authorization while copying the public key!')
             if self.options.auto_authorization_method is None:
-                self.options.auto_authorization_method = 'sshpass' if sshpass_exists else 'expect'
+                self.options.auto_authorization_method = 'pty'  # built-in, doesn't need sshpass/expect
             else:
                 self.options.auto_authorization_method = self.options.auto_authorization_method[0].lower()
-                if self.options.auto_authorization_method not in ['sshpass', 'expect']:
+                if self.options.auto_authorization_method not in ['pty', 'sshpass', 'expect']:
                     self.get_error('-a "' + self.options.auto_authorization_method + '" is not correct!')
-                elif (self.options.auto_authorization_method == 'sshpass' and not sshpass_exists) or \
-                        (self.options.auto_authorization_method == 'expect' and not expect_exists):
+                elif self.options.auto_authorization_method != 'pty' and \
+                        not os.path.isfile('/usr/bin/' + self.options.auto_authorization_method):
                     self.get_error('Please install ' + self.options.auto_authorization_method + ' !')
 
+    def select_servers(self, yml_dict: dict):
+        """ Narrow the scope of the run to --only/--exclude (options.selected) """
+        if not self.options.only and not self.options.exclude:
+            return
+        index = InventoryIndex(yml_dict)
+        self.options.selected = index.select(self.options.only, self.options.exclude)
+        print('Selected %d of %d servers' % (len(self.options.selected), len(index.names)))
+        if not self.options.selected:
+            sys.exit(0)
+
     def get_error(self, message: str):
         self.parser.print_help()
         print('\n', message)
@@ -427,7 +1551,7 @@ class ConfigureDconfTerminal:
         Added what I want to add (i_want_add) and what is in the dconf branch (all_profiles_in_dconf)
         :rtype: list of str
         """
-        return list(set(SpecificMethods.i_want_add(self.yml_dict)) & set(self.all_profiles_in_dconf))
+        return list(set(self.i_want_add()) & set(self.all_profiles_in_dconf))
 
     @property
     def all_profiles_in_dconf(self):
@@ -452,8 +1576,8 @@ class ConfigureDconfTerminal:
         dconf_profile_title_dict = {}
         for profile in ConfigureDconfTerminal.get_relative_list_of_dirnames(self.schema_of_terminal):
             # get it as is
-            title_name: str = StaticMethods.dconf_read_command(
-                self.schema_of_terminal + profile + '/title'
+            title_name: str = StaticMethods.dconf_snapshot_read(
+                self.schema_of_terminal, profile + '/title'
             )
             if title_name:
                 if title_name[0] + title_name[-1] == "''":
@@ -469,9 +1593,12 @@ class ConfigureDconfTerminal:
         :rtype: list
         """
         schema = ConfigureDconfTerminal.schema_of_terminal if schema is None else schema
-        return StaticMethods.dconf_read_command(
-            schema=schema, list_=True
-        ).split('/')[:-1]
+        dirnames = []
+        for section in StaticMethods.dconf_snapshot(schema).keys():
+            dirname = section.split('/')[0]
+            if dirname and dirname not in dirnames:
+                dirnames.append(dirname)
+        return dirnames
 
     @staticmethod
     def check_exists_profile(profile: str, schema: str = None):
@@ -481,12 +1608,18 @@ class ConfigureDconfTerminal:
             return False
         return True
 
+    def i_want_add(self):
+        """ SpecificMethods.i_want_add narrowed by --only/--exclude (options.selected) """
+        if self.options.selected is not None:
+            return self.options.selected
+        return SpecificMethods.i_want_add(self.yml_dict)
+
     @property
     def not_added_in_dconf_yml_servers(self):
         """
         Not added what I want to add (i_want_add) but what is not in dconf branch (all_profiles_in_dconf)
         """
-        return list(set(SpecificMethods.i_want_add(self.yml_dict)) - set(self.all_profiles_in_dconf))
+        return list(set(self.i_want_add()) - set(self.all_profiles_in_dconf))
 
     @staticmethod
     def update_global_profile_list(schema_global_list: str = None, schema_of_terminal: str = None):
@@ -501,7 +1634,11 @@ class ConfigureDconfTerminal:
 
     def __init__(self, yml_dict: dict, options: argparse.Namespace,
                  schema_of_terminal: str = None, schema_global_list: str = None,
-                 save_dir: bool = None, type_f: str = 'Mate'):
+                 save_dir: bool = None, type_f: str = 'Mate', run: bool = True):
+        """
+        Everything that may ask the user (base profile, backup) is done here
+        :param run: also make the changes (else call run() later, see PhaseRunner)
+        """
         self.yml_dict = yml_dict
         self.options = options
 
@@ -509,6 +1646,7 @@ class ConfigureDconfTerminal:
         self.schema_global_list = self.schema_global_list if not schema_global_list else schema_global_list
         self.save_dir = self.save_dir if not save_dir else save_dir
         self.type_f = type_f  # add_new_terminal_profiles_in_dconf
+        self.state = IncrementalState('dconf', self.save_dir)
 
         # overriding methods for convenience ----------------------
         self.update_global_profile_list = lambda: ConfigureDconfTerminal.update_global_profile_list(
@@ -522,34 +1660,59 @@ class ConfigureDconfTerminal:
         self.show_dconf_property(start_message='*** DCONF STATE BEFORE EDITING: ***', show=True)
 
         if not self.options.not_backup:
-            self.dconf_backup()
+            with RunStats.phase('dconf: backup'):
+                self.dconf_backup()
+        if run:
+            self.run()
 
+    def run(self):
+        """ Make the changes in dconf (doesn't ask the user) """
         if self.options.reset_and_exit:
-            self.delete_existing_profiles()
+            with RunStats.phase('dconf: delete profiles'):
+                self.delete_existing_profiles()
         else:
             self.values_of_base_profile = self.get_values_of_base_profile()
-            self.add_new_terminal_profiles_in_dconf()
+            if self.options.incremental and self.options.selected is None:  # others are out of scope
+                with RunStats.phase('dconf: delete removed profiles'):
+                    self.delete_removed_profiles()
+            with RunStats.phase('dconf: add profiles'):
+                self.add_new_terminal_profiles_in_dconf()
+        self.state.save()
         self.show_dconf_property(start_message='*** DCONF STATE AFTER EDITING: ***', show=True)
 
     def dconf_backup(self):
         """
-        Backup branches self.schema_of_terminal and self.schema_global_list
-        in file os.path.join(self.save_dir, 'dconf_restore.txt')
+        Backup branches self.schema_of_terminal and self.schema_global_list (BackupStore, kind 'dconf'),
+        commands to restore them manually are in os.path.join(self.save_dir, 'dconf_restore.txt')
         :return: raise Exception if Failed else None
         """
-        command = StaticMethods.dconf_backup_command(schema=self.schema_of_terminal)
-
+        dump = StaticMethods.dconf_dump_command(self.schema_of_terminal)
+        if dump is False and not StaticMethods.select_yes_or_no(
+                "Command 'dconf dump %s' failed! Do you want to continue anyway?" % self.schema_of_terminal,
+                yes_by_default=False):
+            print('Aborted!')
+            sys.exit(0)
         backup_file = os.path.join(self.save_dir, 'dconf_restore.txt')
-        data = StaticMethods.dconf_read_command(schema=self.schema_global_list)
-        if data:
-            data = 'To restore the original state, enter the following commands in the terminal:\n\n' \
-                   'dconf write %s \"%s\"\n' % (self.schema_global_list, data)
-            data += command + '\n\n' + 'Adminka-root 2023. Welcome with questions ' \
-                                       'to https://github.com/adminka-root ^_^\n'
-            print("\nTo restore the original state see - cat '%s'" % StaticMethods.save_file(backup_file, data))
-        else:
+        profile_list = StaticMethods.dconf_read_command(schema=self.schema_global_list)
+        if not profile_list:
             raise Exception("Can't save the file %s! Aborted!" % backup_file)
 
+        store = BackupStore(keep=self.options.keep_backups, max_age=self.options.backups_max_age)
+        snapshot, new = store.save('dconf', {
+            'dconf:' + self.schema_of_terminal: None if dump is False else dump.encode(),
+            'dconf:' + self.schema_global_list: profile_list.encode(),
+        })
+        data = 'To restore the original state, enter the following commands in the terminal:\n\n' \
+               'dconf write %s \"%s\"\n' % (self.schema_global_list, profile_list)
+        if dump is not False:
+            data += "dconf reset -f %s\nzcat '%s' | dconf load %s\n" % (
+                self.schema_of_terminal, store.object_path(snapshot['items']['dconf:' + self.schema_of_terminal]),
+                self.schema_of_terminal)
+        data += '\nOr run: %s --restore %s -d\n' % (sys.argv[0], snapshot['id'])
+        data += '\n' + 'Adminka-root 2023. Welcome with questions to https://github.com/adminka-root ^_^\n'
+        print("\nBackup %s%s" % (snapshot['id'], '' if new else ' (unchanged)'))
+        print("To restore the original state see - cat '%s'" % StaticMethods.save_file(backup_file, data))
+
     def show_dconf_property(self, start_message: str = 'Dconf:', show: bool = True):
         """ Output the main properties of a class instance is show == True """
         if show:
@@ -586,35 +1749,72 @@ class ConfigureDconfTerminal:
 
         return alt_base_profile
 
-    def delete_existing_profiles(self):
-        """ Delete existing profiles that I want to add """
-        for profile in self.added_in_dconf_yml_servers:
+    def delete_existing_profiles(self, profiles: list = None):
+        """
+        Delete existing profiles that I want to add
+        :param profiles: profiles to delete instead of added_in_dconf_yml_servers
+        """
+        need_reset = []
+        for profile in self.added_in_dconf_yml_servers if profiles is None else profiles:
             if profile != self.options.base_profile:
-                StaticMethods.dconf_reset_command(
-                    self.schema_of_terminal + profile + '/')
+                need_reset.append(profile)
             else:
                 server = self.dconf_profile_title_dict[profile]
                 print("Skipping profile reset %s for server %s!" % (profile, server))
 
+        if len(need_reset) == 1:
+            StaticMethods.dconf_reset_command(self.schema_of_terminal + need_reset[0] + '/')
+        elif need_reset:
+            self.reset_profiles_in_dconf(need_reset)
+        for profile in need_reset:
+            self.state.forget(profile)
+
         # if SpecificMethods.i_want_skeep(self.yml_dict, self.options.base_profile):
         #     print("\nServers", SpecificMethods.i_want_skeep(self.yml_dict, self.options.base_profile),
         #           "were skipped for reset!")
         self.update_global_profile_list()
 
+    def delete_removed_profiles(self):
+        """ Delete profiles created by previous runs, if they are no longer in i_want_add """
+        i_want_add = SpecificMethods.i_want_add(self.yml_dict)
+        removed = []
+        for profile in self.state.servers():
+            if profile not in i_want_add:
+                if profile in self.all_profiles_in_dconf:
+                    removed.append(profile)
+                else:
+                    self.state.forget(profile)
+        if removed:
+            print("\nDeleting profiles removed from yml: %s" % ', '.join(sorted(removed)))
+            self.delete_existing_profiles(removed)
+
+    def reset_profiles_in_dconf(self, profiles: list):
+        """
+        Reset several profiles at once: 'dconf reset -f' of each profile dir, up to options.jobs at the same
+        time. Only these dirs are touched (not the whole branch with the base and other profiles)
+        :param profiles: relative dirnames in self.schema_of_terminal
+        """
+        with ThreadPoolExecutor(max_workers=self.options.jobs) as executor:
+            results = list(executor.map(
+                lambda profile: StaticMethods.dconf_reset_command(self.schema_of_terminal + profile + '/'), profiles))
+        failed = [profile for profile, result in zip(profiles, results) if result is False]
+        if failed:
+            raise Exception("Failed to reset profiles %s!" % failed)
+
     def get_values_of_base_profile(self):
         """ Get the base profile properties specified in the self.yml_dict['opts_key_from_base_profile'] dictionary """
         values_of_base_profile = {}
         for basename in self.yml_dict['opts_key_from_base_profile']:
-            full_schema = self.schema_of_terminal + self.options.base_profile + '/' + basename
-            returned_value = StaticMethods.dconf_read_command(full_schema)
+            returned_value = StaticMethods.dconf_snapshot_read(
+                self.schema_of_terminal, self.options.base_profile + '/' + basename)
             # cast to correct format
             # strings in '' quotes, the rest without
             # note: but if run via terminal (not subprocess of pytho), everything is in ""
             if returned_value:
                 if returned_value[0] + returned_value[-1] in ("''", '""'):
                     returned_value = returned_value[1:-1]
-                if not returned_value or (returned_value[0] != '[' and not returned_value.isdigit() \
-                        and not returned_value.lower() in ('true', 'false')):
+                if not returned_value or (returned_value[0] != '[' and not returned_value.isdigit()
+                                          and not returned_value.lower() in ('true', 'false')):
                     returned_value = "'" + returned_value + "'"
             values_of_base_profile[basename] = returned_value
         return values_of_base_profile
@@ -629,23 +1829,53 @@ class ConfigureDconfTerminal:
         else:
             raise Exception('Method for type_f=%s does not exist in ConfigureDconfTerminal' % self.type_f)
 
-        for server in self.not_added_in_dconf_yml_servers:
+        if self.options.control_persist is not None:  # see get_ssh_command
+            os.makedirs(os.path.expanduser(os.path.dirname(ConfigureSSH.control_path)), mode=0o700, exist_ok=True)
+
+        not_added = self.not_added_in_dconf_yml_servers
+        servers = list(not_added)
+        if self.options.incremental:  # + existing profiles that have changed since the last run
+            servers += [server for server in self.added_in_dconf_yml_servers if server != self.options.base_profile]
+
+        # all new profiles are collected in one keyfile and applied by a single 'dconf load'
+        keyfile = {}
+        for server in servers:
             full_schema_p1 = self.schema_of_terminal + server + '/'
+            profile = {}
             for basename in self.values_of_base_profile.items():
-                full_schema = full_schema_p1 + basename[0]
-                value_in_schema = basename[1]
-                result = StaticMethods.dconf_write_command(full_schema, value_in_schema)
-                if result:
-                    dconf_py_applied_commands.append(result)
+                profile[basename[0]] = basename[1]
 
             for schema_dict in custom_schema_value_dict(full_schema_p1, server):
-                result = StaticMethods.dconf_write_command(
-                    schema_dict['full_schema'], schema_dict["value_in_schema"]
-                )
-                if result:
-                    dconf_py_applied_commands.append(result)
-
-            dconf_py_applied_commands.append('')
+                profile[schema_dict['full_schema'][len(full_schema_p1):]] = schema_dict["value_in_schema"]
+
+            if server in not_added or \
+                    self.state.changed(server, [self.schema_of_terminal, profile]):
+                keyfile[server] = profile
+
+        if keyfile and StaticMethods.dconf_load_command(
+                self.schema_of_terminal, StaticMethods.build_dconf_keyfile(keyfile)):
+            for server, profile in keyfile.items():
+                for basename, value_in_schema in profile.items():
+                    if value_in_schema:
+                        dconf_py_applied_commands.append('dconf write {0} "{1}"'.format(
+                            self.schema_of_terminal + server + '/' + basename, value_in_schema))
+                dconf_py_applied_commands.append('')
+                self.state.update(server, [self.schema_of_terminal, profile])
+        else:  # fallback: key by key, so that one incorrect value does not spoil the rest
+            for server, profile in keyfile.items():
+                written = True
+                for basename, value_in_schema in profile.items():
+                    if not value_in_schema:  # as in the keyfile (see StaticMethods.build_dconf_keyfile)
+                        continue
+                    result = StaticMethods.dconf_write_command(
+                        self.schema_of_terminal + server + '/' + basename, value_in_schema)
+                    if isinstance(result, str):
+                        dconf_py_applied_commands.append(result)
+                    else:
+                        written = False
+                dconf_py_applied_commands.append('')
+                if written:  # else the profile is written again by the next run with -i
+                    self.state.update(server, [self.schema_of_terminal, profile])
         self.update_global_profile_list()
 
         if not self.options.not_backup and dconf_py_applied_commands:
@@ -653,6 +1883,21 @@ class ConfigureDconfTerminal:
                 os.path.join(self.save_dir, 'dconf_applied_commands.txt'),
                 dconf_py_applied_commands)
 
+    def get_ssh_command(self, si: dict):
+        """
+        Command of the terminal profile. It doesn't depend on the ssh config, so the options of the connection
+        that are also written there (see ConfigureSSH.get_host_params) are given on the command line
+        :param si: server_info
+        :rtype: str
+        """
+        command = ['ssh', '-p', str(si['Port'])]
+        if si['ProxyJump']:
+            command += ['-J', si['ProxyJump']]
+        if self.options.control_persist is not None:  # the master connection is shared with sending of keys
+            command += ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + ConfigureSSH.control_path,
+                        '-o', 'ControlPersist=' + self.options.control_persist]
+        return ' '.join(command + [si['User'] + '@' + si['IP']])
+
     def _return_Mate_custom_scheme(self, full_schema_p1, server):
         """
         Returns a custom schema for Mate Terminal
@@ -662,7 +1907,7 @@ class ConfigureDconfTerminal:
         custom_scheme = [
             dict(  # ssh connection command
                 full_schema=full_schema_p1 + 'custom-command',
-                value_in_schema="'ssh -p {0} {1}@{2}'".format(si['Port'], si['User'], si['IP'])
+                value_in_schema="'{0}'".format(self.get_ssh_command(si))
             ),
             dict(  # terminal profile name
                 full_schema=full_schema_p1 + 'visible-name',
@@ -676,9 +1921,512 @@ class ConfigureDconfTerminal:
         return custom_scheme
 
 
+class TaskQueue:
+    """
+    Tasks waiting to be started: no more than jobs are running at the same time and no more than
+    group_limit of one group (for example, hosts behind the same jump host). Groups take turns
+    """
+
+    def __init__(self, tasks, jobs: int, group_of=None, group_limit: int = None):
+        """
+        :param tasks: iterable of tasks, in a group they are started in this order
+        :param group_of: func(task) -> group name or None (such tasks are limited only by jobs)
+        :param group_limit: None - no limit
+        """
+        self.jobs = jobs
+        self.group_of = group_of if group_of is not None else (lambda task: None)
+        self.group_limit = group_limit
+        self.pending = {}  # group -> deque of tasks
+        for task in tasks:
+            self.pending.setdefault(self.group_of(task), deque()).append(task)
+        self.running = {}  # group -> number of started and not finished tasks
+
+    def __bool__(self):
+        """ There are tasks that aren't started yet """
+        return bool(self.pending)
+
+    def can_start(self, group):
+        """ One more task of the group can be started (jobs aside) """
+        return group is None or self.group_limit is None or self.running.get(group, 0) < self.group_limit
+
+    def start(self):
+        """
+        :return: list of tasks that can be started now (they are considered running until finish)
+        """
+        started = []
+        while sum(self.running.values()) < self.jobs:
+            groups = [group for group in self.pending.keys() if self.can_start(group)]
+            if not groups:
+                break
+            for group in groups[:self.jobs - sum(self.running.values())]:  # one task of each group in turn
+                started.append(self.pending[group].popleft())
+                if not self.pending[group]:
+                    del self.pending[group]
+                self.running[group] = self.running.get(group, 0) + 1
+        return started
+
+    def finish(self, task):
+        group = self.group_of(task)
+        self.running[group] -= 1
+        if not self.running[group]:
+            del self.running[group]
+
+
+class PtyPasswordDriver:
+    """
+    Built-in analog of expect.exp: runs programs in pseudo-terminals and enters the password on their own.
+    All sessions are served by one selector loop (without an extra process per host)
+    """
+    PASSWORD_PROMPT: str = 'password:'
+    FAILURE_PATTERNS: tuple = ('failed', 'invalid password')  # as in expect.exp
+
+    def __init__(self, jobs: int = 10, timeout: float = 20, group_of=None, group_limit: int = None):
+        """
+        :param jobs: how many sessions can be active at the same time
+        :param timeout: time limit for each session
+        :param group_of: func(key) -> group name or None, see TaskQueue
+        :param group_limit: how many sessions of one group can be active at the same time
+        """
+        self.jobs = jobs
+        self.timeout = timeout
+        self.group_of = group_of if group_of is not None else (lambda key: None)
+        self.group_limit = group_limit
+
+    def run(self, tasks):
+        """
+        Execute tasks, no more than self.jobs at the same time (and self.group_limit of one group)
+        :param tasks: iterable of (key, command_list, password) or (key, command_list, password, timeout)
+        :return: generator of (key, (returncode or 1 if failed, stdout: str, stderr: str)) in order of completion
+        """
+        tasks = TaskQueue(tasks, self.jobs, group_of=lambda task: self.group_of(task[0]),
+                          group_limit=self.group_limit)
+        selector = selectors.DefaultSelector()
+        sessions = []
+        try:
+            while tasks or sessions:
+                for task in tasks.start():
+                    session = self._spawn(*task)
+                    session['task'] = task
+                    sessions.append(session)
+                    selector.register(session['fd'], selectors.EVENT_READ, session)
+
+                wait = min(session['deadline'] for session in sessions) - time.monotonic()
+                for selector_key, _ in selector.select(max(wait, 0)):
+                    session = selector_key.data
+                    try:
+                        data = os.read(session['fd'], 4096)
+                    except OSError:  # EIO: the program has finished and closed the terminal
+                        data = b''
+                    if not data:
+                        session['result'] = self._wait(session)
+                    else:
+                        self._handle_output(session, data.decode(errors='replace'))
+
+                now = time.monotonic()
+                for session in sessions:
+                    if 'result' not in session and session['deadline'] <= now:
+                        session['result'] = self._abort(session, 'Timeout of %s seconds expired' % session['timeout'])
+
+                for session in [session for session in sessions if 'result' in session]:
+                    selector.unregister(session['fd'])
+                    os.close(session['fd'])
+                    sessions.remove(session)
+                    tasks.finish(session['task'])
+                    yield session['key'], session['result']
+        finally:  # for example, the generator was closed early
+            for session in sessions:
+                selector.unregister(session['fd'])
+                os.close(session['fd'])
+                if 'result' not in session:
+                    self._abort(session, 'Aborted')
+            selector.close()
+
+    def _spawn(self, key, command_list: list, password: str, timeout: float = None):
+        """
+        Start the program in a new pseudo-terminal (it will be the controlling terminal for ssh)
+        :param timeout: default is self.timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        pid, fd = pty.fork()
+        if pid == 0:  # child
+            try:
+                os.execvp(command_list[0], command_list)
+            finally:
+                os._exit(127)
+        return dict(key=key, pid=pid, fd=fd, password=password, output='', unmatched='',
+                    command=command_list, started=time.monotonic(),
+                    timeout=timeout, deadline=time.monotonic() + timeout)
+
+    def _handle_output(self, session: dict, data: str):
+        """ Answer the password prompt or abort the session if one of FAILURE_PATTERNS is found """
+        session['output'] += data
+        session['unmatched'] += data
+        while True:
+            found = [(session['unmatched'].find(pattern), pattern)
+                     for pattern in (self.PASSWORD_PROMPT,) + self.FAILURE_PATTERNS]
+            found = [match for match in found if match[0] != -1]
+            if not found:
+                # keep the tail: the pattern could be split between two reads
+                session['unmatched'] = session['unmatched'][-64:]
+                return
+            index, pattern = min(found)
+            if pattern != self.PASSWORD_PROMPT:
+                session['result'] = self._abort(session, "Found '%s' in the output" % pattern)
+                return
+            os.write(session['fd'], (session['password'] + '\r').encode())
+            session['unmatched'] = session['unmatched'][index + len(pattern):]
+
+    @staticmethod
+    def _wait(session: dict):
+        """ Reap the finished program """
+        status = os.waitpid(session['pid'], 0)[1]
+        RunStats.record_command(session['command'], session['started'], time.monotonic())
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        return returncode, PtyPasswordDriver._hide_password(session), ''
+
+    @staticmethod
+    def _abort(session: dict, reason: str):
+        """ Kill and reap the program """
+        try:
+            os.kill(session['pid'], signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(session['pid'], 0)
+        RunStats.record_command(session['command'], session['started'], time.monotonic())
+        return 1, PtyPasswordDriver._hide_password(session), reason + '\n'
+
+    @staticmethod
+    def _hide_password(session: dict):
+        """ The output of the terminal may contain an echo of the password """
+        if not session['password']:
+            return session['output']
+        return session['output'].replace(session['password'], '********')
+
+
+class ManagedSshConfig:
+    """
+    Ssh config, in which ok_ssh owns only the region between BEGIN_MARKER and END_MARKER.
+    The rest of the file (user content) is passed through as is. Changes are kept in memory
+    until write(), which replaces the file atomically (temp file + rename).
+    Hosts can also be written to fragments (one file per group in config.d), then the managed block
+    contains only 'Include' of them
+    """
+    BEGIN_MARKER: str = '# BEGIN ok_ssh managed block (generated by ok_ssh, manual changes will be lost)'
+    END_MARKER: str = '# END ok_ssh managed block'
+    MAX_HOST_LINE: int = 1000  # length of 'Host a b c ...' lines in compact form
+    FRAGMENTS_DIRNAME: str = 'config.d'  # near the config file
+    FRAGMENT_PATTERN: str = 'ok_ssh_%s.conf'
+
+    def __init__(self, config_file: str, empty: bool = False, compact: bool = False,
+                 fragments: bool = False, group_of=None):
+        """
+        :param empty: ignore the current content of the file (it will be completely overwritten)
+        :param compact: write options shared by several hosts once, in 'Host a b c ...' blocks (see render_block)
+        :param fragments: write hosts to fragments instead of the managed block
+        :param group_of: func(host) -> group name, determines the fragment of the host
+        """
+        self.config_file = config_file
+        self.compact = compact
+        self.fragments = fragments
+        self.group_of = group_of if group_of is not None else (lambda host: 'default')
+        self.fragments_dir = os.path.join(os.path.dirname(os.path.abspath(config_file)), self.FRAGMENTS_DIRNAME)
+
+        self.original = None if empty else StaticMethods.read_file(config_file)
+        before, block, after = self.split_lines(self.original.splitlines() if self.original else [])
+        self.user_configs = [SshConfigFile(before), SshConfigFile(after)]  # user content around the block
+        self.user_configs_modified = [False, False]  # hosts were moved/removed from user content
+        self.managed = self.parse_block(block)  # dict(host = dict(key = value, ...), ...)
+
+        # fragments written by previous runs (also in the mode without fragments: their hosts are moved back)
+        self.original_fragments = {}  # path -> content
+        for path in glob.glob(os.path.join(self.fragments_dir, self.FRAGMENT_PATTERN % '*')):
+            self.original_fragments[path] = StaticMethods.read_file(path)
+            if not empty:
+                self.managed.update(self.parse_block(self.original_fragments[path].splitlines()))
+        self.changed = empty or bool(self.original_fragments) != fragments
+
+    def split_lines(self, lines: list):
+        """
+        :return: lines before the managed block, lines of the block (without markers), lines after the block
+        """
+        if self.BEGIN_MARKER in lines:
+            begin = lines.index(self.BEGIN_MARKER)
+            if self.END_MARKER in lines[begin:]:
+                end = lines.index(self.END_MARKER, begin)
+                return lines[:begin], lines[begin + 1:end], lines[end + 1:]
+        return lines, [], []
+
+    @staticmethod
+    def parse_block(lines: list):
+        """
+        Parse the managed block (it is always written by render_block, so a simple parser is enough).
+        Parameters of 'Host a b c ...' blocks belong to each of the hosts
+        :rtype: dict
+        """
+        managed = {}
+        params_list = []
+        for line in lines:
+            key_value = line.strip().split(None, 1)
+            if len(key_value) != 2 or key_value[0].startswith('#'):
+                continue
+            key, value = key_value
+            if key.lower() == 'host':
+                params_list = [managed.setdefault(host, {}) for host in value.split()]
+                continue
+            for params in params_list:
+                if key in params:  # several values (IdentityFile, for example)
+                    params[key] = (params[key] if isinstance(params[key], list) else [params[key]]) + [value]
+                else:
+                    params[key] = value
+        return managed
+
+    def render_block(self, compact: bool = None):
+        """
+        Managed block as lines, hosts are sorted (so that diffs of the config are small).
+        In compact form each host keeps only its Hostname and options that differ, and options shared by
+        several hosts are written once in 'Host a b c ...' blocks. Every option of a host is still set
+        in exactly one place, so the resolved config (ssh -G) is the same
+        :param compact: default is self.compact
+        """
+        return [self.BEGIN_MARKER] + self.render_hosts(self.managed.keys(), compact) + [self.END_MARKER]
+
+    def render_hosts(self, hosts, compact: bool = None):
+        """
+        :param hosts: hosts from self.managed
+        :param compact: see render_block
+        :return: lines
+        """
+        compact = self.compact if compact is None else compact
+        lines = []
+        hosts = sorted(hosts)
+        if not compact:
+            for host in hosts:
+                lines += self._render_host([host], self.managed[host].items())
+            return lines
+
+        options = {}  # host -> list of (key, value), Hostname is always individual
+        counter = {}  # (key, value) -> number of hosts with this option
+        for host in hosts:
+            options[host] = [(key, tuple(value) if isinstance(value, list) else value)
+                             for key, value in self.managed[host].items() if key.lower() != 'hostname']
+            for option in options[host]:
+                counter[option] = counter.get(option, 0) + 1
+
+        groups = {}  # shared options -> hosts
+        host_group = {}
+        for host in hosts:
+            shared = tuple(sorted((x for x in options[host] if counter[x] > 1), key=lambda x: x[0].lower()))
+            groups.setdefault(shared, []).append(host)
+            host_group[host] = shared
+
+        for host in hosts:
+            if len(groups[host_group[host]]) > 1:  # only Hostname and real differences
+                params = [(key, value) for key, value in self.managed[host].items()
+                          if key.lower() == 'hostname' or
+                          (key, tuple(value) if isinstance(value, list) else value) not in host_group[host]]
+            else:
+                params = self.managed[host].items()
+            if params:
+                lines += self._render_host([host], params)
+
+        for shared, group_hosts in groups.items():
+            if len(group_hosts) < 2 or not shared:
+                continue
+            chunk = []
+            for host in group_hosts:
+                if chunk and len('Host ' + ' '.join(chunk + [host])) > self.MAX_HOST_LINE:
+                    lines += self._render_host(chunk, shared)
+                    chunk = []
+                chunk.append(host)
+            lines += self._render_host(chunk, shared)
+        return lines
+
+    def render_fragments(self):
+        """
+        :return: dict(path of the fragment = content)
+        """
+        groups = {}
+        for host in self.managed.keys():
+            groups.setdefault(re.sub(r'[^\w.-]', '_', str(self.group_of(host))), []).append(host)
+        fragments = {}
+        for group, hosts in groups.items():
+            lines = ['# Generated by ok_ssh (group %s), manual changes will be lost' % group, '']
+            fragments[os.path.join(self.fragments_dir, self.FRAGMENT_PATTERN % group)] = \
+                '\n'.join(lines + self.render_hosts(hosts)) + '\n'
+        return fragments
+
+    @staticmethod
+    def _render_host(hosts: list, params):
+        """
+        :param params: iterable of (key, value or list/tuple of values)
+        :return: lines of 'Host ...' block
+        """
+        lines = ['Host %s' % ' '.join(hosts)]
+        for key, values in params:
+            for value in values if isinstance(values, (list, tuple)) else [values]:
+                lines.append('  %s %s' % (key, value))
+        lines.append('')
+        return lines
+
+    def hosts(self):
+        """
+        All hosts of the config: user content and managed block
+        :rtype: tuple
+        """
+        return self.user_configs[0].hosts() + tuple(self.managed.keys()) + self.user_configs[1].hosts()
+
+    def _remove_from_user_config(self, host: str):
+        """
+        Remove the host from user content
+        :return: parameters of the removed host or None if it's not found
+        """
+        for index, user_config in enumerate(self.user_configs):
+            if host in user_config.hosts():
+                params = user_config.host(host)
+                user_config.remove(host)
+                self.user_configs_modified[index] = True
+                return params
+        return None
+
+    def add(self, host: str, **kwargs):
+        """ Add a host to the managed block (keys with the value None are skipped) """
+        if host in self.hosts():
+            raise ValueError("Host %s: exists (use set)." % host)
+        self.managed[host] = {key: value for key, value in kwargs.items() if value is not None}
+        self.changed = True
+
+    def set(self, host: str, **kwargs):
+        """
+        Overwrite values of the host (others are kept, the value None removes the key). A host from user
+        content (for example, written by old versions of ok_ssh) is moved to the managed block
+        """
+        if host not in self.managed:
+            params = self._remove_from_user_config(host)
+            if params is None:
+                raise ValueError("Host %s: not found" % host)
+            self.managed[host] = params
+
+        params = self.managed[host]
+        for key, value in kwargs.items():
+            for old_key in [x for x in params.keys() if x.lower() == key.lower()]:
+                del params[old_key]
+            if value is not None:
+                params[key] = value
+        self.changed = True
+
+    def remove(self, host: str):
+        """ Remove the host from the managed block or user content """
+        if host in self.managed:
+            del self.managed[host]
+        elif self._remove_from_user_config(host) is None:
+            raise ValueError("Host %s: not found." % host)
+        self.changed = True
+
+    def config(self, compact: bool = None, fragments: bool = None):
+        """
+        :param compact: see render_block
+        :param fragments: default is self.fragments
+        :return: the whole config as str
+        """
+        fragments = self.fragments if fragments is None else fragments
+        before, after = [
+            (StaticMethods.delete_newlines(user_config.config()) if modified else user_config.config()).splitlines()
+            for user_config, modified in zip(self.user_configs, self.user_configs_modified)
+        ]
+        while before and not before[-1].strip():
+            before.pop()
+        while after and not after[0].strip():
+            after.pop(0)
+        if fragments:  # 'Match all' resets the context of the previous Host block for Include
+            block = [self.BEGIN_MARKER, 'Match all', 'Include %s' % os.path.join(
+                self.fragments_dir, self.FRAGMENT_PATTERN % '*'), self.END_MARKER]
+        else:
+            block = self.render_block(compact)
+        lines = before + ([''] if before else []) + block + ([''] + after if after else [])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Replace the config file (and changed fragments) atomically (temp file in the same dir + rename),
+        only if something changed. Fragments of groups that no longer exist are deleted
+        :return: True if something was written
+        """
+        if not self.changed:
+            return False
+        written = False
+
+        fragments = self.render_fragments() if self.fragments else {}
+        for path, data in fragments.items():
+            if self.original_fragments.get(path) != data:
+                StaticMethods.write_file_atomically(path, data)
+                written = True
+        for path in self.original_fragments.keys():
+            if path not in fragments:
+                os.remove(path)
+                written = True
+        self.original_fragments = fragments
+
+        data = self.config()
+        if data != self.original:
+            StaticMethods.write_file_atomically(self.config_file, data)
+            self.original = data
+            written = True
+        self.changed = False
+        return written
+
+    def verify_compact(self, jobs: int = 10):
+        """
+        Check with 'ssh -G' that the compact and the expanded forms of the config resolve
+        every managed host identically
+        :return: list of hosts that resolve differently
+        """
+        files = {}
+        try:
+            for compact in (False, True):
+                fd, files[compact] = tempfile.mkstemp(prefix='.ok_ssh_verify.')
+                with os.fdopen(fd, 'w') as file:
+                    file.write(self.config(compact, fragments=False))
+
+            def resolve(host):
+                return [StaticMethods.run_popen(['ssh', '-G', '-F', files[compact], host])
+                        for compact in (False, True)]
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                return [host for host, (expanded, compacted) in zip(self.managed.keys(), executor.map(
+                    resolve, self.managed.keys())) if expanded != compacted or expanded[0]]
+        finally:
+            for file in files.values():
+                os.remove(file)
+
+
 class ConfigureSSH:
     """ Changing the ssh config file and sending key + auto authorization on a remote server """
     config_file: str = os.path.expanduser('~/.ssh/config')
+    key_probe_cache_file: str = os.path.join(SCRIPT_DIR, 'key_probe_cache.json')
+    key_probe_cache_ttl: float = 7 * 24 * 60 * 60  # seconds, see probe_key_auth
+    checkpoint_file: str = os.path.join(SCRIPT_DIR, 'send_keys_checkpoint.jsonl')  # see open_checkpoint
+    control_path: str = '~/.ssh/ok_ssh_cm/%C'  # %C - hash of local host, remote host, port and user
+    latency_factor: float = 50  # round trips of sending the key, see check_reachability
+    min_send_key_timeout: float = 5  # seconds, limits of the time limit derived from the latency
+    max_send_key_timeout: float = 60
+    known_hosts_file: str = os.path.expanduser('~/.ssh/known_hosts')
+    keyscan_chunk: int = 16  # hosts per ssh-keyscan (it scans them concurrently itself)
+    jump_control_persist: str = '60'  # without options.control_persist, see get_jump_ssh_command
+    retry_delay: float = 1  # seconds before the first retry, doubled for each next one (see get_retry_delay)
+    retry_delay_max: float = 30
+    # (failure class, transient, patterns of ssh/ssh-copy-id output), the first match wins (see classify_failure)
+    FAILURE_CLASSES: tuple = (
+        ('host key mismatch', False, ('REMOTE HOST IDENTIFICATION HAS CHANGED', 'Host key verification failed')),
+        ('auth rejected', False, ('Permission denied (', 'Permission denied, please try again',
+                                  'Too many authentication failures', 'Authentication failed', 'invalid password')),
+        ('remote error', False, ('No space left on device', 'Disk quota exceeded', 'Read-only file system',
+                                 'Permission denied', 'cannot create')),
+        ('timeout', True, ('timed out', 'Timeout of')),
+        ('unreachable', True, ('Connection refused', 'No route to host', 'Network is unreachable',
+                               'Could not resolve hostname', 'Name or service not known',
+                               'Connection reset', 'Connection closed', 'kex_exchange_identification')),
+    )
+    OTHER_FAILURE: str = 'other'  # not transient
 
     @property
     def added_in_config_hosts(self):
@@ -686,7 +2434,7 @@ class ConfigureSSH:
         Added what I want to add (i_want_add) and what is in config file
         :rtype: list of str
         """
-        return list(set(SpecificMethods.i_want_add(self.yml_dict)) & set(self.ssh_config.hosts()))
+        return list(set(self.i_want_add()) & set(self.ssh_config.hosts()))
 
     @property
     def not_added_in_config_hosts(self):
@@ -694,17 +2442,20 @@ class ConfigureSSH:
         Not added what I want to add (i_want_add) but what is not in config file
         :rtype: list of str
         """
-        return list(set(SpecificMethods.i_want_add(self.yml_dict)) - set(self.ssh_config.hosts()))
+        return list(set(self.i_want_add()) - set(self.ssh_config.hosts()))
 
-    @staticmethod
-    def delete_newlines_in_config_file(config_file: str = None):
-        """ Replace 2 or more consecutive newlines with 2 newlines """
-        config_file = ConfigureSSH.config_file if config_file is None else config_file
-        data = StaticMethods.read_file(config_file)
-        data = StaticMethods.delete_newlines(data)
-        StaticMethods.save_file(config_file, data, False)
+    def i_want_add(self):
+        """ SpecificMethods.i_want_add narrowed by --only/--exclude (options.selected) """
+        if self.options.selected is not None:
+            return self.options.selected
+        return SpecificMethods.i_want_add(self.yml_dict)
 
-    def __init__(self, yml_dict: dict, options: argparse.Namespace, send_key_timeout: float = 60):
+    def __init__(self, yml_dict: dict, options: argparse.Namespace, send_key_timeout: float = 60,
+                 run: bool = True):
+        """
+        Everything that may ask the user (creating of the config, backup) is done here
+        :param run: also make the changes (else call run() later, see PhaseRunner)
+        """
         self.yml_dict = yml_dict
         self.options = options
         self.send_key_timeout = send_key_timeout
@@ -712,32 +2463,57 @@ class ConfigureSSH:
         self.config_file = self.get_ssh_config_canonical_path()
         os.chmod(os.path.dirname(self.config_file), int('700', base=8))
 
-        # overriding methods for convenience ----------------------
-        self.delete_newlines_in_config_file = \
-            lambda: ConfigureSSH.delete_newlines_in_config_file(self.config_file)
-        # ---------------------------------------------------------
+        if self.options.control_persist is not None:
+            os.makedirs(os.path.expanduser(os.path.dirname(self.control_path)), mode=0o700, exist_ok=True)
 
-        self.ssh_config = read_ssh_config(self.config_file)
+        self.ssh_config = self.read_ssh_config()
+        self.config_state = IncrementalState('ssh_config')
+        self.keys_state = IncrementalState('ssh_keys')
         self.show_config_property(start_message='*** SSH CONFIG STATE BEFORE EDITING: ***', show=True)
 
         if not self.options.not_backup:
-            StaticMethods.backup_file(self.config_file)
-
+            with RunStats.phase('ssh: backup'):
+                self.backup()
+        if run:
+            self.run()
+
+    def backup(self):
+        """ Backup the ssh config and its fragments (BackupStore, kind 'ssh') """
+        items = {self.config_file: self.ssh_config.original.encode() if self.ssh_config.original is not None
+                 else None}
+        for path, data in self.ssh_config.original_fragments.items():
+            items[path] = data.encode()
+        store = BackupStore(keep=self.options.keep_backups, max_age=self.options.backups_max_age)
+        snapshot, new = store.save('ssh', items)
+        print("\nBackup %s%s of '%s'" % (snapshot['id'], '' if new else ' (unchanged)', self.config_file))
+
+    def run(self):
+        """ Change the ssh config and send keys (doesn't ask the user) """
         if self.options.clear_ssh_config:
             # ??? if not added and not not_added -> only remove all data
             # strange desire of the user, but so be it. I'm tired and lazy
-            self.ssh_config = empty_ssh_config_file()
-            self.ssh_config.write(self.config_file)
-            self.ssh_config = read_ssh_config(self.config_file)
+            self.ssh_config = self.read_ssh_config(empty=True)
+            for host in self.config_state.servers():
+                self.config_state.forget(host)
         elif self.options.reset_and_exit:
             self.delete_existing_profiles()
 
         if not self.options.reset_and_exit:
-            self.modify_params_of_existed_profiles()
-            self.create_profiles()
-            if self.options.auto_authorization:
+            with RunStats.phase('ssh: update config'):
+                if self.options.incremental and self.options.selected is None:  # others are out of scope
+                    self.delete_removed_profiles()
+                self.modify_params_of_existed_profiles()
+                self.create_profiles()
+        if self.options.compact_ssh_config and self.options.verify_ssh_config:
+            with RunStats.phase('ssh: verify config'):
+                self.verify_compact_config()
+        with RunStats.phase('ssh: write config'):
+            self.ssh_config.write()  # the only write of the config per run
+        if not self.options.reset_and_exit and self.options.auto_authorization:
+            with RunStats.phase('ssh: send keys'):
                 self.send_keys_to_hosts()
-        self.delete_newlines_in_config_file()
+        self.config_state.save()
+        self.keys_state.save()
         self.show_config_property(start_message='*** SSH CONFIG STATE BEFORE EDITING: ***', show=True)
 
     def show_config_property(self, start_message: str = 'Ssh config:', show: bool = True):
@@ -750,33 +2526,93 @@ class ConfigureSSH:
             print("Desired NOT added = %s" % formatting(self.not_added_in_config_hosts))
             print("All profiles      = %s" % formatting(self.ssh_config.hosts()))
 
-    def delete_existing_profiles(self):
-        """ Delete existing profiles from ssh config that I want to add """
-        for host in self.added_in_config_hosts:
+    def read_ssh_config(self, empty: bool = False):
+        """
+        :param empty: see ManagedSshConfig
+        :rtype: ManagedSshConfig
+        """
+        return ManagedSshConfig(
+            self.config_file, empty=empty, compact=self.options.compact_ssh_config,
+            fragments=self.options.ssh_config_fragments,
+            group_of=lambda host: SpecificMethods.server_group(self.yml_dict, host),
+        )
+
+    def verify_compact_config(self):
+        """ Make sure that the compact form of the config resolves hosts as the expanded one, else raise Exception """
+        print("\nChecking the compact ssh config with 'ssh -G' ...")
+        differ = self.ssh_config.verify_compact(jobs=self.options.jobs)
+        if differ:
+            raise Exception("The compact ssh config resolves hosts %s differently! The config is not changed" % (
+                ', '.join(sorted(differ))))
+        print("The compact ssh config resolves all %d hosts identically" % len(self.ssh_config.managed))
+
+    def delete_existing_profiles(self, hosts: list = None):
+        """
+        Delete existing profiles from ssh config that I want to add
+        :param hosts: hosts to delete instead of added_in_config_hosts
+        """
+        for host in self.added_in_config_hosts if hosts is None else hosts:
             self.ssh_config.remove(host)
-        self.ssh_config.save()
+            self.config_state.forget(host)
+            self.keys_state.forget(host)
+
+    def delete_removed_profiles(self):
+        """ Delete entries created by previous runs, if they are no longer in i_want_add """
+        i_want_add = SpecificMethods.i_want_add(self.yml_dict)
+        removed = []
+        for host in self.config_state.servers():
+            if host not in i_want_add:
+                if host in self.ssh_config.hosts():
+                    removed.append(host)
+                else:
+                    self.config_state.forget(host)
+                    self.keys_state.forget(host)
+        if removed:
+            print("\nDeleting entries removed from yml: %s" % ', '.join(sorted(removed)))
+            self.delete_existing_profiles(removed)
+
+    def get_host_params(self, host: str):
+        """
+        Parameters of the host entry in the ssh config
+        :return: dict(Hostname, Port, User, IdentityFile, IdentitiesOnly, ProxyJump)
+        """
+        si = SpecificMethods.server_info(self.yml_dict, host)
+        params = dict(
+            Hostname=si['IP'], Port=si['Port'],
+            User=si['User'], IdentityFile=si['IdentityFile'],
+            IdentitiesOnly='yes', ProxyJump=si['ProxyJump'],  # None - removed from the entry
+        )
+        if self.options.control_persist is not None:
+            params.update(ControlMaster='auto', ControlPath=self.control_path,
+                          ControlPersist=self.options.control_persist)
+        return params
+
+    def get_control_options(self):
+        """
+        Options of ssh for connections of the key sending. The first of them becomes the master connection
+        of the host, the rest (and terminal sessions, see get_host_params) are multiplexed over it
+        :return: list of ssh arguments (empty if options.control_persist isn't set)
+        """
+        if self.options.control_persist is None:
+            return []
+        return ['-o', 'ControlMaster auto', '-o', 'ControlPath ' + self.control_path,
+                '-o', 'ControlPersist ' + self.options.control_persist]
 
     def modify_params_of_existed_profiles(self):
         """ Update according to yaml dictionary existing profiles from ssh config that I want to add """
         for host in self.added_in_config_hosts:
-            si = SpecificMethods.server_info(self.yml_dict, host)
-            self.ssh_config.set(
-                host, Hostname=si['IP'], Port=si['Port'],
-                User=si['User'], IdentityFile=si['IdentityFile'],
-                IdentitiesOnly='yes',
-            )
-        self.ssh_config.save()
+            params = self.get_host_params(host)
+            if self.options.incremental and not self.config_state.changed(host, [self.config_file, params]):
+                continue
+            self.ssh_config.set(host, **params)
+            self.config_state.update(host, [self.config_file, params])
 
     def create_profiles(self):
         """ Create entries for missing hosts in the ssh config """
         for host in self.not_added_in_config_hosts:
-            si = SpecificMethods.server_info(self.yml_dict, host)
-            self.ssh_config.add(
-                host, Hostname=si['IP'], Port=si['Port'],
-                User=si['User'], IdentityFile=si['IdentityFile'],
-                IdentitiesOnly='yes',
-            )
-        self.ssh_config.save()
+            params = self.get_host_params(host)
+            self.ssh_config.add(host, **params)
+            self.config_state.update(host, [self.config_file, params])
 
     def get_ssh_config_canonical_path(self):
         """ Obtaining a canonical path of ssh config """
@@ -803,67 +2639,708 @@ class ConfigureSSH:
         sys.exit(1)
 
     def send_keys_to_hosts(self):
-        """ Send public keys to remote hosts. Note: need execute AFTER saving the updated configuration! """
-        if self.options.auto_authorization_method == 'sshpass':
-            re_send_key_to_host = lambda si: self._send_key_to_host_sshpass(si)
-        else:  # elif self.options.auto_authorization_method == 'expect':
-            self.expect = os.path.join(SCRIPT_DIR, 'expect.exp')
-            re_send_key_to_host = lambda si: self._send_key_to_host_expect(si)
-
-        error_data = []
-        success_data = []
-        log_file = os.path.join('/tmp', 'ssh-copy-id.log')
+        """ Send public keys to remote hosts. Note: need execute AFTER writing the updated configuration! """
+        hosts_info = {}
+        for host in sorted(self.added_in_config_hosts):  # the order is the same in every run (see --resume)
+            hosts_info[host] = SpecificMethods.server_info(self.yml_dict, host)
+
         print()
-        for host in self.added_in_config_hosts:
-            si = SpecificMethods.server_info(self.yml_dict, host)
-            host_info = "Host: '{0}', User: '{1}', IP: '{2}'".format(host, si['User'], si['IP'])
-            print('Sending key to %s ...' % host, end="\r")
-            result = re_send_key_to_host(si)
-            if result[0]:  # got error
-                print('Sending key to %s [FAILED]' % host)
-                error_data.append("---- %s:\nStdout:\n%s\nStderr:\n%s----\n" %
-                                  (host_info, result[1], result[2]))
-            else:
-                print('Sending key to %s [__OK__]' % host)
-                success_data.append(host_info)
-        if error_data:
-            print("\nFailed to send public key to {0} out of {1} servers!".format(
-                len(error_data), len(self.added_in_config_hosts)))
-            success_and_error_data = \
-                "******************** SUCCESSFUL TRANSMISSION OF THE PUBLIC KEY: ********************\n\n" + \
-                '\n\n'.join(success_data) + "\n*********************************** END SUCCESS *****************" + \
-                "*******************" if success_data else "Don't worry, someday it will work ^_^"
-            success_and_error_data += \
-                "\n\n\n************************ FAILED TRANSMISSION OF PUBLIC KEY: ************************\n\n" + \
-                '\n\n'.join(error_data) + \
-                "\n************************************ END FAILED ************************************\n"
-            log_file = StaticMethods.save_file(log_file, success_and_error_data)
-            print("To view the log, run: cat '%s'" % log_file)
-        elif success_data:
+        self.open_result_log()
+        self.open_checkpoint()
+        try:
+            failures, succeeded = self._send_keys_to_hosts(hosts_info)
+            self.checkpoint.write(json.dumps(dict(complete=True)) + '\n')
+        finally:
+            self.result_log.close()
+            self.checkpoint.close()
+        StaticMethods.save_file(self.key_probe_cache_file, json.dumps(self.key_probe_cache, indent=1),
+                                time_postfix=False, chmod='600')
+        failed = sum(failures.values())
+        if failed:
+            print("\nFailed to send public key to {0} out of {1} servers!".format(failed, failed + succeeded))
+            for failure in [failure for failure, _, _ in self.FAILURE_CLASSES] + [self.OTHER_FAILURE]:
+                if failure in failures:
+                    print('  %s: %d' % (failure, failures[failure]))
+            print("To view the log, run: cat '%s'" % self.result_log_file)
+        elif succeeded:
             print("\nSuccessful sending of keys to all servers!")
-        self.ssh_config.save()
 
-    def _send_key_to_host_sshpass(self, si: dict):
-        """ Automatic password entry is performed by the program 'sshpass' """
+    def _send_keys_to_hosts(self, hosts_info: dict):
+        """
+        See send_keys_to_hosts
+        :param hosts_info: dict(host = server_info, ...)
+        :return: dict(failure class = number of failed hosts, ...), number of hosts with the sent key
+        """
+        self.opened_jumps = set()  # see open_jump_connections
+        self.behind_failed_jumps = set()  # hosts not sent because their jump host failed, see _push_keys
+        if self.options.resume:
+            for host in list(hosts_info.keys()):
+                if self.checkpoint_done.get(host) == self.get_key_record(hosts_info[host]):
+                    self.report_result(host, hosts_info[host], 'skipped', 'done in the interrupted run')
+                    self.keys_state.update(host, self.get_key_record(hosts_info[host]))
+                    del hosts_info[host]
+
+        if self.options.incremental:
+            for host in list(hosts_info.keys()):
+                if not self.keys_state.changed(host, self.get_key_record(hosts_info[host])):
+                    self.report_result(host, hosts_info[host], 'skipped', 'unchanged since the last run')
+                    del hosts_info[host]
+
+        failures = {}  # failure class -> number of hosts
+        unreachable = {}  # hosts to check again before the next round of sending
+        if self.options.connect_timeout:
+            unreachable = self.drop_unreachable(hosts_info, 1, failures)
+
+        self.key_probe_cache = self.read_key_probe_cache()
+        self.prepare_hosts(hosts_info)
+
+        succeeded = 0
+        with RunStats.phase('ssh: push keys'):
+            for attempt in range(1, self.options.retries + 2):
+                retry = {}
+                # results are printed and logged in order of completion
+                for host, result in self._push_keys(hosts_info):
+                    si = hosts_info[host]
+                    if not result[0]:
+                        succeeded += 1
+                        self.report_result(host, si, 'ok', result=result)
+                        self.remember_key_accepted(si)
+                        self.keys_state.update(host, self.get_key_record(si))
+                        continue
+                    if host in self.behind_failed_jumps:  # not retried for each server behind the jump host
+                        failure, transient = self.OTHER_FAILURE, False
+                    else:
+                        failure, transient = self.classify_failure(result)
+                    if transient and attempt <= self.options.retries:
+                        retry[host] = si
+                        self.report_result(host, si, 'retry', failure, result=result)
+                    else:
+                        failures[failure] = failures.get(failure, 0) + 1
+                        self.report_result(host, si, 'failed', failure, result=result)
+                if not retry and not unreachable:
+                    break
+                delay = self.get_retry_delay(attempt)
+                print('\nRetry %d of %d for %d hosts in %.1f seconds\n' % (
+                    attempt, self.options.retries, len(retry) + len(unreachable), delay))
+                time.sleep(delay)
+                hosts_info = retry
+                if unreachable:
+                    reachable = unreachable
+                    unreachable = self.drop_unreachable(reachable, attempt + 1, failures)
+                    self.prepare_hosts(reachable)
+                    hosts_info.update(reachable)
+        return failures, succeeded
+
+    def drop_unreachable(self, hosts_info: dict, attempt: int, failures: dict):
+        """
+        Remove unreachable hosts from hosts_info (see check_reachability). Until the last round of sending
+        they are retried (checked again before the next round), then they are failed
+        :param hosts_info: dict(host = server_info, ...)
+        :param attempt: number of the round of sending
+        :param failures: dict(failure class = number of failed hosts, ...), is updated
+        :return: dict(host = server_info, ...) of unreachable hosts to retry
+        """
+        with RunStats.phase('ssh: check reachability'):
+            unreachable = self.check_reachability(hosts_info)
+        retry = {}
+        for host in sorted(unreachable):
+            si = hosts_info.pop(host)
+            result = (1, '', '%s:%s is unreachable\n' % (si['IP'], si['Port']))
+            if attempt <= self.options.retries:
+                retry[host] = si
+                self.report_result(host, si, 'retry', 'unreachable', result=result)
+            else:
+                failures['unreachable'] = failures.get('unreachable', 0) + 1
+                self.report_result(host, si, 'failed', 'unreachable', result=result)
+        return retry
+
+    def prepare_hosts(self, hosts_info: dict):
+        """
+        Add host keys to known_hosts (options.scan_host_keys) and remove hosts that already accept
+        the key from hosts_info (if not options.force_send_keys)
+        :param hosts_info: dict(host = server_info, ...)
+        """
+        if not hosts_info:
+            return
+        if self.options.scan_host_keys:
+            with RunStats.phase('ssh: populate known_hosts'):
+                self.populate_known_hosts(hosts_info)
+
+        if not self.options.force_send_keys:
+            with RunStats.phase('ssh: probe keys'):
+                accepted = self.probe_key_auth(hosts_info)
+            for host in sorted(accepted):
+                self.report_result(host, hosts_info[host], 'skipped', 'the key is already accepted')
+                self.keys_state.update(host, self.get_key_record(hosts_info[host]))
+                del hosts_info[host]
+
+    def _push_keys(self, hosts_info: dict):
+        """
+        Send keys by options.auto_authorization_method. Hosts behind a jump host that gets the key
+        in the same call wait for it (the connection to the jump host is made with the key).
+        Hosts behind a jump host that failed get its result and are added to self.behind_failed_jumps
+        :param hosts_info: dict(host = server_info, ...)
+        :return: generator of (host, result of StaticMethods.run_popen) in order of completion
+        """
+        pending = dict(hosts_info)
+        while pending:
+            stage = {host: si for host, si in pending.items()
+                     if not set(self.get_jump_hops(si)) & set(pending.keys())}
+            stage = stage or dict(pending)  # jump hosts behind each other
+            for host in stage.keys():
+                del pending[host]
+
+            failed_jumps = self.open_jump_connections(stage)
+            for host in sorted(stage.keys()):
+                if stage[host]['ProxyJump'] in failed_jumps:
+                    returncode, stdout, stderr = failed_jumps[stage.pop(host)['ProxyJump']]
+                    self.behind_failed_jumps.add(host)
+                    yield host, (returncode or 1, '', 'Jump host %s: %s' % (
+                        hosts_info[host]['ProxyJump'], stdout + stderr))
+
+            if self.options.auto_authorization_method == 'pty':
+                yield from self._send_keys_to_hosts_pty(stage)
+            elif self.options.auto_authorization_method == 'sshpass':
+                yield from self._run_in_pool(stage, lambda si: self._send_key_to_host_sshpass(si))
+            else:  # elif self.options.auto_authorization_method == 'expect':
+                self.expect = os.path.join(SCRIPT_DIR, 'expect.exp')
+                yield from self._run_in_pool(stage, lambda si: self._send_key_to_host_expect(si))
+
+    @staticmethod
+    def get_jump_hops(si: dict):
+        """ :return: list of jump hosts of the server (see SpecificMethods.server_proxy_jump) """
+        return si['ProxyJump'].split(',') if si['ProxyJump'] else []
+
+    def open_jump_connections(self, hosts_info: dict):
+        """
+        Concurrently open the master connection to each jump host of hosts_info that isn't open yet.
+        Connections of all hosts behind the jump host are multiplexed over it (see get_jump_options),
+        so the jump host gets one login instead of one per host
+        :param hosts_info: dict(host = server_info, ...)
+        :return: dict(ProxyJump = result of StaticMethods.run_popen, ...) of jump hosts that failed
+        """
+        jumps = sorted({si['ProxyJump'] for si in hosts_info.values() if si['ProxyJump']} - self.opened_jumps)
+        if not jumps:
+            return {}
+        os.makedirs(os.path.expanduser(os.path.dirname(self.control_path)), mode=0o700, exist_ok=True)
+        failed = {}
+        with ThreadPoolExecutor(max_workers=self.options.jobs) as executor:
+            results = executor.map(lambda jump: StaticMethods.run_popen(
+                self.get_jump_ssh_command(jump) + ['true'], timeout=self.send_key_timeout), jumps)
+            for jump, result in zip(jumps, results):
+                if result[0]:
+                    failed[jump] = result
+                else:
+                    self.opened_jumps.add(jump)
+        if failed:
+            print('Failed to connect to jump hosts: %s' % ', '.join(sorted(failed.keys())))
+        return failed
+
+    def get_jump_ssh_command(self, jump: str):
+        """
+        ssh to the last jump host (through the previous ones) with the key only, as the master connection
+        :param jump: ProxyJump of the server
+        :rtype: list
+        """
+        hops = jump.split(',')
+        command = ['ssh', '-o', 'ControlMaster auto', '-o', 'ControlPath ' + self.control_path,
+                   '-o', 'ControlPersist ' + (self.options.control_persist or self.jump_control_persist),
+                   '-o', 'BatchMode yes', '-o', 'ConnectTimeout %d' % max(int(self.send_key_timeout), 1)]
+        if len(hops) > 1:
+            command += ['-J', ','.join(hops[:-1])]
+        # [user@]host[:port] isn't a destination of ssh, but ssh://[user@]host[:port] is
+        return command + [('ssh://' + hops[-1]) if ':' in hops[-1] else hops[-1]]
+
+    def get_jump_options(self, si: dict):
+        """
+        Options of ssh for connections through the jump host of the server: instead of ProxyJump, the proxy
+        is the master connection of the jump host (see open_jump_connections)
+        :return: list of ssh arguments (empty if the server has no jump host)
+        """
+        if not si['ProxyJump']:
+            return []
+        proxy_command = [argument.replace('%', '%%') for argument in self.get_jump_ssh_command(si['ProxyJump'])]
+        proxy_command[-1:-1] = ['-W', '%h:%p']  # %h and %p are expanded by the outer ssh
+        return ['-o', 'ProxyCommand ' + ' '.join(shlex.quote(argument) for argument in proxy_command)]
+
+    @staticmethod
+    def classify_failure(result: tuple):
+        """
+        Class of the failure by the output of ssh-copy-id (with pty, stderr of ssh is in stdout)
+        :param result: result of StaticMethods.run_popen
+        :return: failure class (see FAILURE_CLASSES), whether the failure is transient (worth a retry)
+        """
+        output = result[1] + result[2]
+        for failure, transient, patterns in ConfigureSSH.FAILURE_CLASSES:
+            if any(pattern in output for pattern in patterns):
+                return failure, transient
+        return ConfigureSSH.OTHER_FAILURE, False
+
+    def get_retry_delay(self, attempt: int):
+        """
+        Exponential backoff with jitter: hosts that failed together (a restarted router, MaxStartups of sshd)
+        are not retried at the same moment by parallel runs
+        :param attempt: number of the failed attempt, from 1
+        """
+        delay = min(self.retry_delay * 2 ** (attempt - 1), self.retry_delay_max)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def open_checkpoint(self):
+        """
+        Journal of the run: hosts that are done (the key is sent or already accepted) are written as soon
+        as they are done. With options.resume, hosts done by the previous (interrupted) run are read from it
+        (self.checkpoint_done) before it is started again
+        """
+        self.checkpoint_done = {}  # host -> get_key_record
+        if self.options.resume and os.path.isfile(self.checkpoint_file):
+            records = []
+            for line in StaticMethods.read_file(self.checkpoint_file).splitlines():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:  # the last line may be cut off
+                    break
+            if records and records[-1].get('complete'):
+                print('The previous run was not interrupted, there is nothing to resume')
+            else:
+                self.checkpoint_done = {record['host']: record['record'] for record in records if 'host' in record}
+                print('Resuming: %d hosts were done in the interrupted run' % len(self.checkpoint_done))
+        self.checkpoint_file = StaticMethods.save_file(self.checkpoint_file, '', time_postfix=False, chmod='600')
+        self.checkpoint = open(self.checkpoint_file, 'a', buffering=1)
+
+    def open_result_log(self):
+        """
+        Log of sending keys: one JSON record per host (see report_result), written as soon as the result
+        is known, so the log can be watched while the run is in progress (tail -f)
+        """
+        log_file = os.path.join('/tmp', 'ssh-copy-id.jsonl')
+        self.result_log_file = StaticMethods.save_file(log_file, '', chmod='600')  # passwords may be in output
+        self.result_log = open(self.result_log_file, 'a', buffering=1)
+
+    def report_result(self, host: str, si: dict, status: str, reason: str = None, result: tuple = None,
+                      done: bool = None):
+        """
+        Print the result of sending the key and append it to the log (and to the checkpoint if the host is done)
+        :param status: 'ok', 'failed', 'retry' (failed, will be sent again) or 'skipped'
+        :param reason: why the host was skipped or the class of the failure
+        :param result: result of StaticMethods.run_popen
+        :param done: the host doesn't need to be processed by --resume; default - if it didn't fail
+        """
+        line = 'Sending key to %s %s' % (host, dict(ok='[__OK__]', failed='[FAILED]', retry='[RETRY]',
+                                                    skipped='[SKIPPED]')[status])
+        print(line + (' (%s)' % reason if reason else ''))
+        record = dict(time=datetime.now().isoformat(timespec='seconds'), host=host, user=si['User'],
+                      ip=si['IP'], port=si['Port'], status=status)
+        if reason:
+            record['reason'] = reason
+        if result is not None:
+            record.update(returncode=result[0], stdout=result[1], stderr=result[2])
+        self.result_log.write(json.dumps(record) + '\n')
+        if done is None:
+            done = status not in ('failed', 'retry')
+        if done:
+            self.checkpoint.write(json.dumps(dict(host=host, record=self.get_key_record(si))) + '\n')
+
+    def check_reachability(self, hosts_info: dict):
+        """
+        Concurrent TCP connection to ip:port of all hosts. Reachable hosts get their own time limit of
+        sending the key ('Timeout' in server_info): latency_factor * connection time, but not less than
+        min_send_key_timeout and not more than max_send_key_timeout.
+        Hosts behind jump hosts are not checked
+        :param hosts_info: dict(host = server_info, ...)
+        :return: set of unreachable hosts
+        """
+        latencies = StaticMethods.tcp_connect_latencies(
+            {host: (si['IP'], si['Port']) for host, si in hosts_info.items() if not si['ProxyJump']},
+            timeout=self.options.connect_timeout,
+        )
+        unreachable = set()
+        for host, latency in latencies.items():
+            if latency is None:
+                unreachable.add(host)
+            else:
+                hosts_info[host]['Timeout'] = min(max(self.latency_factor * latency, self.min_send_key_timeout),
+                                                  self.max_send_key_timeout)
+        return unreachable
+
+    def populate_known_hosts(self, hosts_info: dict):
+        """
+        Collect host keys of hosts that are not in known_hosts yet (ssh-keyscan, concurrently) and add them
+        in one write. After that, connections to hosts with known keys use strict checking
+        ('StrictHostKeyChecking' in server_info). Hosts behind jump hosts are skipped (ssh-keyscan can't reach them)
+        :param hosts_info: dict(host = server_info, ...)
+        """
+        data = StaticMethods.read_file(self.known_hosts_file) if os.path.isfile(self.known_hosts_file) else ''
+        entries = StaticMethods.parse_known_hosts(data)
+        names = {}  # known_hosts_name -> hosts
+        for host, si in hosts_info.items():
+            if si['ProxyJump']:
+                continue
+            names.setdefault(StaticMethods.known_hosts_name(si['IP'], si['Port']), []).append(host)
+        unknown = {name: hosts_info[hosts[0]] for name, hosts in names.items()
+                   if not StaticMethods.known_hosts_keys(entries, name)}
+
+        by_port = {}
+        for name in sorted(unknown.keys()):
+            by_port.setdefault(str(unknown[name]['Port']), []).append(unknown[name]['IP'])
+        commands = []
+        scan_timeout = max(int(self.options.connect_timeout or self.send_key_timeout), 1)
+        for port, ips in by_port.items():
+            for index in range(0, len(ips), self.keyscan_chunk):
+                commands.append(['ssh-keyscan', '-T', str(scan_timeout), '-p', port] +
+                                ips[index:index + self.keyscan_chunk])
+        new_lines = []
+        with ThreadPoolExecutor(max_workers=self.options.jobs) as executor:
+            for result in executor.map(lambda command: StaticMethods.run_popen(
+                    command, timeout=scan_timeout * 3 + 5), commands):
+                for patterns, key_type, key in StaticMethods.parse_known_hosts(result[1]):
+                    if patterns[0] not in unknown or (key_type, key) in \
+                            StaticMethods.known_hosts_keys(entries, patterns[0]):
+                        continue
+                    name = StaticMethods.hash_known_hosts_name(patterns[0]) \
+                        if self.options.hash_known_hosts else patterns[0]
+                    new_lines.append(' '.join([name, key_type, key]))
+                    entries.append(([patterns[0]], key_type, key))
+
+        if new_lines:
+            StaticMethods.write_file_atomically(
+                self.known_hosts_file, data + ('\n' if data and not data.endswith('\n') else '') +
+                '\n'.join(new_lines) + '\n')
+        not_scanned = 0
+        for name, hosts in names.items():
+            known = bool(StaticMethods.known_hosts_keys(entries, name))
+            not_scanned += not known
+            for host in hosts:
+                if known:
+                    hosts_info[host]['StrictHostKeyChecking'] = 'yes'
+        print('Known hosts: %d keys added for %d hosts, %d hosts were already known, %d hosts were not scanned' % (
+            len(new_lines), len(unknown) - not_scanned, len(names) - len(unknown), not_scanned))
+
+    def get_send_key_timeout(self, si: dict):
+        """ See check_reachability """
+        return si.get('Timeout', self.send_key_timeout)
+
+    def probe_key_auth(self, hosts_info: dict):
+        """
+        Concurrently check which hosts already accept our key (public key authentication in BatchMode,
+        i.e. without a password). Hosts from self.key_probe_cache are not checked again
+        :param hosts_info: dict(host = server_info, ...)
+        :return: set of hosts that accept the key
+        """
+        need_probe = {}
+        accepted = set()
+        for host, si in hosts_info.items():
+            if self.get_key_probe_cache_key(si) in self.key_probe_cache:
+                accepted.add(host)
+            else:
+                need_probe[host] = si
+        failed_jumps = self.open_jump_connections(need_probe)
+        need_probe = {host: si for host, si in need_probe.items() if si['ProxyJump'] not in failed_jumps}
+
+        for host, result in self._run_in_pool(need_probe, lambda si: self._probe_key_auth_host(si)):
+            if not result[0]:
+                accepted.add(host)
+                self.remember_key_accepted(hosts_info[host])
+        return accepted
+
+    def read_key_probe_cache(self):
+        """
+        Hosts that accepted our key during the last self.key_probe_cache_ttl seconds
+        :return: dict(get_key_probe_cache_key = timestamp, ...)
+        :rtype: dict
+        """
+        cache = StaticMethods.read_json(self.key_probe_cache_file, default={})
+        now = time.time()
+        return {key: timestamp for key, timestamp in cache.items() if now - timestamp < self.key_probe_cache_ttl}
+
+    def remember_key_accepted(self, si: dict):
+        """ Add the host to self.key_probe_cache (will be saved at the end of send_keys_to_hosts) """
+        cache_key = self.get_key_probe_cache_key(si)
+        if cache_key is not None:
+            self.key_probe_cache[cache_key] = time.time()
+
+    @staticmethod
+    def get_key_record(si: dict):
+        """ What the key transmission depends on (see IncrementalState) """
+        return [ConfigureSSH.get_key_probe_cache_key(si), si['AuthorizationFile']]
+
+    @staticmethod
+    def get_key_probe_cache_key(si: dict):
+        """
+        :return: 'user@ip:port fingerprint' (+ ' via jump host') or None if the public key can't be read
+        """
+        fingerprint = StaticMethods.get_public_key_fingerprint(si['AuthorizationFile'])
+        if fingerprint is None:
+            return None
+        cache_key = '{0}@{1}:{2} {3}'.format(si['User'], si['IP'], si['Port'], fingerprint)
+        if si.get('ProxyJump'):  # the same private address may be behind different jump hosts
+            cache_key += ' via ' + si['ProxyJump']
+        return cache_key
+
+    def _probe_key_auth_host(self, si: dict):
+        """
+        Log in with the private key only, never asking for a password. The master connection of the host
+        (see get_control_options) is not used: it may be authorized by the password
+        """
         return StaticMethods.run_popen(command_list=[
-            'sshpass', '-p', si['Password'],
-            'ssh-copy-id', '-o', 'StrictHostKeyChecking no',
+            'ssh', '-o', 'ControlMaster no', '-o', 'ControlPath none', *self.get_jump_options(si),
+            '-o', 'BatchMode yes',
+            '-o', 'StrictHostKeyChecking ' + si.get('StrictHostKeyChecking', 'no'),
             '-o', 'IdentitiesOnly yes',
-            '-i', si['AuthorizationFile'], '-f',
+            '-o', 'ConnectTimeout %d' % max(int(self.get_send_key_timeout(si)), 1),
+            '-i', si['IdentityFile'],
             '-p', str(si['Port']),
             si['User'] + '@' + si['IP'],
-        ], timeout=self.send_key_timeout)
+            'true',
+        ], timeout=self.get_send_key_timeout(si))
 
-    def _send_key_to_host_expect(self, si: dict):
-        """ Automatic password entry is performed by the program 'expect' """
-        return StaticMethods.run_popen(command_list=[
-            self.expect, si['Password'],
-            'ssh-copy-id', '-o', 'StrictHostKeyChecking no',
+    def _run_in_pool(self, hosts_info: dict, send_key_to_host):
+        """
+        Up to options.jobs send_key_to_host (or other func with the same signature) at the same time,
+        up to options.jobs_per_jump of them behind the same jump host
+        :param hosts_info: dict(host = server_info, ...)
+        :param send_key_to_host: func(server_info) -> result of StaticMethods.run_popen
+        :return: generator of (host, result) in order of completion
+        """
+        queue = TaskQueue(hosts_info.keys(), self.options.jobs, group_of=lambda host: hosts_info[host]['ProxyJump'],
+                          group_limit=self.options.jobs_per_jump)
+        executor = ThreadPoolExecutor(max_workers=self.options.jobs)
+        futures = {}
+        try:
+            while queue or futures:
+                for host in queue.start():
+                    futures[executor.submit(send_key_to_host, hosts_info[host])] = host
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host = futures.pop(future)
+                    queue.finish(host)
+                    yield host, future.result()
+        finally:  # Ctrl-C or the generator was closed early: don't start the rest
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _send_keys_to_hosts_pty(self, hosts_info: dict):
+        """
+        Automatic password entry is performed by PtyPasswordDriver (without sshpass/expect)
+        :param hosts_info: dict(host = server_info, ...)
+        :return: generator of (host, result) in order of completion
+        """
+        tasks = []
+        for host, si in hosts_info.items():
+            tasks.append((host, self.get_ssh_copy_id_command(si), si['Password'], self.get_send_key_timeout(si)))
+        return PtyPasswordDriver(jobs=self.options.jobs, timeout=self.send_key_timeout,
+                                 group_of=lambda host: hosts_info[host]['ProxyJump'],
+                                 group_limit=self.options.jobs_per_jump).run(tasks)
+
+    def get_ssh_copy_id_command(self, si: dict):
+        """
+        ssh-copy-id with -f makes the only connection (mkdir + append to authorized_keys),
+        with options.control_persist it stays open as the master connection of the host
+        :rtype: list
+        """
+        return [
+            'ssh-copy-id', *self.get_control_options(), *self.get_jump_options(si),
+            '-o', 'StrictHostKeyChecking ' + si.get('StrictHostKeyChecking', 'no'),
             '-o', 'IdentitiesOnly yes',
             '-i', si['AuthorizationFile'], '-f',
             '-p', str(si['Port']),
             si['User'] + '@' + si['IP'],
-        ], timeout=self.send_key_timeout)
+        ]
+
+    def _send_key_to_host_sshpass(self, si: dict):
+        """ Automatic password entry is performed by the program 'sshpass' """
+        return self._hide_password(StaticMethods.run_popen(command_list=[
+            'sshpass', '-p', si['Password'],
+            *self.get_ssh_copy_id_command(si),
+        ], timeout=self.get_send_key_timeout(si)), si['Password'])
+
+    def _send_key_to_host_expect(self, si: dict):
+        """ Automatic password entry is performed by the program 'expect' """
+        return self._hide_password(StaticMethods.run_popen(command_list=[
+            self.expect, si['Password'],
+            *self.get_ssh_copy_id_command(si),
+        ], timeout=self.get_send_key_timeout(si)), si['Password'])
+
+    @staticmethod
+    def _hide_password(result: tuple, password: str):
+        """
+        The output may contain the password (on timeout, the command line is in stderr), as with
+        PtyPasswordDriver it is masked before it is printed or logged
+        :param result: result of StaticMethods.run_popen
+        """
+        if not password:
+            return result
+        return result[0], result[1].replace(password, '********'), result[2].replace(password, '********')
+
+
+class RestoreBackups:
+    """
+    --restore: put the ssh config (with fragments) and the dconf branches of the terminal back as they were
+    in snapshots of BackupStore. Everything is read first, then files are replaced atomically and dconf
+    gets one 'dconf load' (after one 'dconf reset -f' if there are keys that weren't in the snapshot).
+    If a step fails, the steps already done are rolled back. The current state is backed up before,
+    so the restore can be undone by restoring that backup
+    """
+
+    def __init__(self, options: argparse.Namespace, run: bool = True):
+        """
+        Everything that may ask the user is done here
+        :param run: also restore (else call run() later)
+        """
+        self.options = options
+        self.store = BackupStore(keep=options.keep_backups, max_age=options.backups_max_age)
+        kinds = [kind for kind, selected in (('ssh', options.ssh_config_actions), ('dconf', options.dconf_actions))
+                 if selected] or ['ssh', 'dconf']  # -s/-d narrow it
+
+        self.snapshots = {}  # kind -> snapshot
+        for kind in kinds:
+            for snapshot in reversed(self.store.snapshots()):
+                if snapshot['kind'] == kind and snapshot['id'].startswith(options.restore):
+                    self.snapshots[kind] = snapshot
+                    break
+        if not self.snapshots:
+            raise Exception("\n\nError! No backups%s to restore (see --list_backups)" % (
+                " matching '%s'" % options.restore if options.restore else ''))
+
+        # contents are read before the backup of the current state (it may prune the snapshot)
+        self.contents = {kind: {name: None if hash_ is None else self.store.get_object(hash_)
+                                for name, hash_ in snapshot['items'].items()}
+                         for kind, snapshot in self.snapshots.items()}
+        print('\nBackups to restore:')
+        for kind, snapshot in self.snapshots.items():
+            print('  %s (%s): %s' % (snapshot['id'], snapshot['time'].replace('T', ' '),
+                                     ', '.join(sorted(snapshot['items'].keys()))))
+        if not StaticMethods.select_yes_or_no('The current state will be replaced. Do you want to continue?'):
+            print('Aborted!')
+            sys.exit(0)
+        if run:
+            self.run()
+
+    def run(self):
+        """ Restore all snapshots or nothing """
+        undo = []  # funcs without arguments, the rollback of the steps that have been started
+        try:
+            if 'ssh' in self.snapshots:
+                with RunStats.phase('restore: ssh'):
+                    self.restore_ssh(self.contents['ssh'], undo)
+            if 'dconf' in self.snapshots:
+                with RunStats.phase('restore: dconf'):
+                    self.restore_dconf(self.contents['dconf'], undo)
+        except BaseException:
+            print('\nRestoring failed, rolling back...')
+            for func in reversed(undo):
+                try:
+                    func()
+                except Exception as Err:  # roll back the rest anyway
+                    print('Rollback failed: %s' % str(Err).strip())
+            raise
+
+        # servers applied by previous runs are not applied anymore (see --incremental)
+        for section in [dict(ssh='ssh_config', dconf='dconf')[kind] for kind in self.snapshots.keys()]:
+            state = IncrementalState(section)
+            for server in state.servers():
+                state.forget(server)
+            state.save()
+        for kind, snapshot in self.snapshots.items():
+            print('Restored %s' % snapshot['id'])
+
+    def backup_current(self, kind: str, current: dict):
+        """ Backup of the state before restoring """
+        snapshot, _ = self.store.save(kind, current)
+        print("\nThe current state is backed up as %s (to undo: --restore %s)" % (snapshot['id'], snapshot['id']))
+
+    def restore_ssh(self, contents: dict, undo: list):
+        """
+        :param contents: dict(path = content: bytes or None if absent, ...) of the snapshot
+        :param undo: rollback funcs are added to it
+        """
+        contents = dict(contents)
+        for path in list(contents.keys()):  # fragments written after the snapshot are removed
+            fragments_dir = os.path.join(os.path.dirname(path), ManagedSshConfig.FRAGMENTS_DIRNAME)
+            for fragment in glob.glob(os.path.join(fragments_dir, ManagedSshConfig.FRAGMENT_PATTERN % '*')):
+                contents.setdefault(fragment, None)
+        current = {path: StaticMethods.read_file(path, mode='rb') if os.path.isfile(path) else None
+                   for path in contents.keys()}
+        self.backup_current('ssh', current)
+
+        def put(path: str, data):
+            if data is not None:
+                StaticMethods.write_file_atomically(path, data)
+            elif os.path.isfile(path):
+                os.remove(path)
+
+        # fragments first (the config includes them), removed files last
+        in_fragments_dir = lambda path: os.path.basename(os.path.dirname(path)) == ManagedSshConfig.FRAGMENTS_DIRNAME
+        for path in sorted(contents.keys(),
+                           key=lambda path: (contents[path] is None, not in_fragments_dir(path), path)):
+            if contents[path] != current[path]:
+                undo.append(lambda path=path: put(path, current[path]))
+                put(path, contents[path])
+
+    def restore_dconf(self, contents: dict, undo: list):
+        """
+        :param contents: dict('dconf:' + dir (ends with '/') = dump or key = value: bytes, ...) of the snapshot
+        :param undo: rollback funcs are added to it
+        """
+        current = {}
+        for name in contents.keys():
+            path = name[len('dconf:'):]
+            if path.endswith('/'):
+                data = StaticMethods.dconf_dump_command(path)
+                if data is False:
+                    raise Exception("\n\nError! Command 'dconf dump %s' failed!" % path)
+            else:
+                data = StaticMethods.dconf_read_command(path) or ''
+            current[name] = data.encode()
+        self.backup_current('dconf', current)
+
+        parent, keyfile = self.build_dconf_keyfile(contents)
+        _, current_keyfile = self.build_dconf_keyfile(current)
+        # keys that weren't in the snapshot can only be removed by reset (of the dirs that have them)
+        reset = sorted({name[len('dconf:'):] for name, data in contents.items() if name.endswith('/')
+                        and data is not None and not self.keys_of(current[name]) <= self.keys_of(data)})
+
+        def load(keyfile_: str, reset_: list):
+            for path in reset_:
+                if StaticMethods.dconf_reset_command(path) is False:
+                    raise Exception("\n\nError! Command 'dconf reset -f %s' failed!" % path)
+            if not StaticMethods.dconf_load_command(parent, keyfile_):
+                raise Exception("\n\nError! Command 'dconf load %s' failed!" % parent)
+
+        undo.append(lambda: load(current_keyfile, reset))
+        load(keyfile, reset)
+
+    @staticmethod
+    def keys_of(dump: bytes):
+        """ :return: set of (relative dir, key) of the dump """
+        return {(section, key) for section, values in StaticMethods.parse_dconf_keyfile(dump.decode()).items()
+                for key in values.keys()}
+
+    @staticmethod
+    def build_dconf_keyfile(contents: dict):
+        """
+        One keyfile for all dirs and keys of contents (relative to their common parent dir)
+        :param contents: see restore_dconf
+        :return: parent dir, keyfile for 'dconf load'
+        :rtype: tuple
+        """
+        paths = [name[len('dconf:'):] for name in contents.keys()]
+        parent = os.path.commonpath([path if path.endswith('/') else os.path.dirname(path) for path in paths])
+        parent = parent.rstrip('/') + '/'
+        keyfile = {}
+        for name, data in contents.items():
+            path = name[len('dconf:'):]
+            if data is None:
+                continue
+            if path.endswith('/'):  # dump of the dir
+                relative = path[len(parent):]
+                for section, values in StaticMethods.parse_dconf_keyfile(data.decode()).items():
+                    section = relative.rstrip('/') if section == '/' else relative + section
+                    keyfile.setdefault(section or '/', {}).update(values)
+            elif data:  # value of the key
+                section, _, key = path[len(parent):].rpartition('/')
+                keyfile.setdefault(section or '/', {})[key] = data.decode()
+        return parent, StaticMethods.build_dconf_keyfile(keyfile)
 
 
 if __name__ == "__main__":
@@ -872,9 +3349,32 @@ if __name__ == "__main__":
     TIME_POSTFIX = cli_parameters.options.time_postfix
     StaticMethods.TIME_POSTFIX = TIME_POSTFIX
 
-    yml_data = SpecificMethods.read_yml(yml_file=cli_parameters.options.yml_config)
-    if cli_parameters.options.dconf_actions:
-        ConfigureDconfTerminal(yml_dict=yml_data, options=cli_parameters.options)
-    if cli_parameters.options.ssh_config_actions:
-        ConfigureSSH(yml_dict=yml_data, options=cli_parameters.options, send_key_timeout=10)
+    if cli_parameters.options.list_backups:
+        print(BackupStore().describe())
+        sys.exit(0)
+    if cli_parameters.options.restore is not None:
+        RestoreBackups(options=cli_parameters.options)
+        sys.exit(0)
+
+    RunStats.enabled = cli_parameters.options.stats or cli_parameters.options.trace is not None
+    try:
+        with RunStats.phase('read_yml'):
+            yml_data = SpecificMethods.read_yml(yml_file=cli_parameters.options.yml_config,
+                                                use_cache=not cli_parameters.options.no_inventory_cache)
+            cli_parameters.select_servers(yml_data)
+        # questions to the user are asked by the constructors, before the phases are started
+        phases = []
+        if cli_parameters.options.dconf_actions:
+            phases.append(('dconf', ConfigureDconfTerminal(yml_dict=yml_data, options=cli_parameters.options,
+                                                           run=False).run))
+        if cli_parameters.options.ssh_config_actions:
+            # sending keys is the longest phase, its progress is shown as is (the first phase of PhaseRunner)
+            phases.insert(0, ('ssh', ConfigureSSH(yml_dict=yml_data, options=cli_parameters.options,
+                                                  send_key_timeout=10, run=False).run))
+        PhaseRunner().run(phases)
+    finally:
+        if cli_parameters.options.stats:
+            print(RunStats.summary())
+        if cli_parameters.options.trace is not None:
+            print("\nTrace: '%s'" % RunStats.save_trace(cli_parameters.options.trace))
 